@@ -1,22 +1,25 @@
 import os
 import time
-import json
+time0 = time.perf_counter()  # for the startup time metric
 
-from flask import Flask, render_template, request, jsonify, url_for, redirect
+from flask import (Flask, render_template, request, jsonify, url_for, redirect,
+                   abort, Response, stream_with_context)
 from flask_wtf.csrf import CSRFProtect
 
 import commands
 import database
-import scraping
 import model
 import ratings
-import evaluation
+import ids
+import metrics
 import plotting
-from model import Results, Races, Racers
+import prediction
+import search
+from cache import ComponentCache
+from metrics import phase
+from model import Results, Races, Racers, Counters
 from forms import RaceForm, CategoryForm, RacerForm
 
-from preprocess import clean
-
 
 app = Flask(__name__)
 app.config.from_object(os.environ['APP_SETTINGS'])
@@ -24,12 +27,13 @@ app.config.from_object(os.environ['APP_SETTINGS'])
 csrf = CSRFProtect(app)
 database.init_app(app)
 commands.init_app(app)
+metrics.init_app(app)
 
-# Pre-compute counts
-with app.app_context():
-    COUNTS = {table: eval(f'{table}.count()')
-                    for table in ['Races', 'Results', 'Racers']}
-print('App initialized.')
+# Race tables, racer histories, plots and table counts, keyed by the
+# ratings version of the database (Counters.get_cache_version)
+components = ComponentCache()
+metrics.metrics.set('app_startup_seconds', time.perf_counter() - time0)
+print(f'App initialized in {time.perf_counter() - time0:.2f} s.')
 
 # global default race/category/racer
 RACE_ID = 5291 # 10000 #11557
@@ -40,16 +44,16 @@ def check_data_selection(race_id=None, category_index=None, racer_id=None):
     """Makes sure that we are trying to show data that is in the database."""
 
     errors = []
-    if not race_id in Races.get_column('race_id'):
-        race_id = Races.get_random_id()
+    if not race_id in ids.get_ids('race_id'):
+        race_id = ids.get_ids('race_id').random()
         errors.append('race')
     categories = Races.get_categories(race_id)
     if category_index >= len(categories):
         category_index = 0
         errors.append('category')
-    if not racer_id in Racers.get_column('RacerID'):
+    if not racer_id in ids.get_ids('RacerID'):
         # Random racer from the currently selected category
-        racer_id = Results.get_random_racer_id(racer_id,
+        racer_id = Results.get_random_racer_id(race_id,
                                                categories[category_index])
         errors.append('racer')
 
@@ -63,41 +67,59 @@ def index_get():
     category_index = int(request.args.get('category', CATEGORY_INDEX))
     racer_id = int(request.args.get('racer', RACER_ID))
 
-    error_redirect = check_data_selection(race_id, category_index, racer_id)
+    with phase('validate'):
+        error_redirect = check_data_selection(race_id, category_index,
+                                              racer_id)
     if error_redirect:
         return error_redirect
 
-    race_form = RaceForm(race_id)
-    categories = Races.get_categories(race_id)
-    category_form = CategoryForm(categories)
-    racer_form = RacerForm(racer_id)
+    with phase('forms'):
+        race_form = RaceForm(race_id)
+        categories = Races.get_categories(race_id)
+        category_form = CategoryForm(categories)
+        racer_form = RacerForm(racer_id)
 
-    # Reset data in form fields to show placeholder text again
-    race_form.reset_placeholder(race_id)
-    racer_form.reset_placeholder(racer_id)
+        # Reset data in form fields to show placeholder text again
+        race_form.reset_placeholder(race_id)
+        racer_form.reset_placeholder(racer_id)
 
     category_name = categories[category_index]
-    race_table = Results.get_race_table(race_id, category_name).all()
-    race_name = Races.get_race_name(race_id)
-    race_date = Races.get_race_date(race_id)
-    racer_table = model.get_racer_table(racer_id)
-    racer_name = Racers.get_racer_name(racer_id)
-
-    racer_plot = plotting.make_racer_plot(racer_table,
-                                          avg=Racers.get_avg_rating())
-
-    r = render_template('index.html',
-                           race_form=race_form,
-                           category_form=category_form,
-                           racer_form=racer_form,
-                           race_table=race_table,
-                           race_name=race_name,
-                           race_date=race_date,
-                           category_name=category_name,
-                           racer_table=racer_table,
-                           racer_name=racer_name,
-                           counts=COUNTS,
-                           racer_plot=racer_plot)
+
+    # Page components only change when ratings change
+    version = Counters.get_cache_version()
+    with phase('race'):
+        race_table, race_name, race_date = components.get_or_compute(
+            ('race', race_id, category_name, version),
+            lambda: (model.get_race_rows(race_id, category_name),
+                     Races.get_race_name(race_id),
+                     Races.get_race_date(race_id)))
+    with phase('racer'):
+        racer_table, racer_name = components.get_or_compute(
+            ('racer', racer_id, version),
+            lambda: (model.get_racer_table(racer_id),
+                     Racers.get_racer_name(racer_id)))
+    with phase('plot'):
+        racer_plot = components.get_or_compute(
+            ('racer_plot', racer_id, version),
+            lambda: plotting.make_racer_plot(racer_table,
+                                             avg=Racers.get_avg_rating()))
+
+    counts = components.get_or_compute(('counts', version),
+                                       model.get_table_counts)
+
+    with phase('render'):
+        r = render_template('index.html',
+                               race_form=race_form,
+                               category_form=category_form,
+                               racer_form=racer_form,
+                               race_table=race_table,
+                               race_name=race_name,
+                               race_date=race_date,
+                               category_name=category_name,
+                               racer_table=racer_table,
+                               racer_name=racer_name,
+                               counts=counts,
+                               racer_plot=racer_plot)
 
     return r
 
@@ -154,14 +176,9 @@ def error():
 def race_suggestions(box):
     """Create search suggestions when searching races or racers"""
 
-    if box == 'race_name':
-        Table = Races
-    elif box == 'racer_name':
-        Table = Racers
-
     query = request.args.get('query').lower()
     suggestions = [{'value': option} for option in
-                    Table.get_suggestions(query, limit=5)]
+                    search.get_suggestions(box, query, limit=5)]
 
     return jsonify({"suggestions": suggestions})
 
@@ -189,6 +206,8 @@ def preview_database(methods=['GET', 'POST']):
         drop_tables = parse_tables(request.args.get('drop'))
         commands.db_drop_all(drop_tables)
         commands.db_create_all(drop_tables)
+        for Table in drop_tables:
+            Table.save_count()
 
         add_tables = parse_tables(request.args.get('add'))
 
@@ -203,11 +222,21 @@ def preview_database(methods=['GET', 'POST']):
             Results.add_table(Races.get_urls())
         if Racers in add_tables:
             Racers.add_table()
+        if drop_tables or add_tables:
+            # include new races and racers in suggestions and ID checks
+            search.refresh()
+            ids.refresh()
+            model.race_cache.clear()
+            # racer histories and table counts changed
+            Counters.increment('ratings_version')
+            database.db.session.commit()
 
         if request.args.get('reset'):
             ratings.reset_ratings()
         if request.args.get('rate'):
-            ratings.get_all_ratings(request.args.get('limit'))
+            ratings.get_all_ratings(request.args.get('limit'),
+                                    only_new=request.args.get('rate') == 'new',
+                                    resume=request.args.get('rate') == 'resume')
 
     # Table is the appropriate class (default Results if no table param)
     Table = eval(str(request.args.get('table'))) or Results
@@ -218,11 +247,73 @@ def preview_database(methods=['GET', 'POST']):
     return render_template('database.html', cols=cols, rows=rows)
 
 
+@app.route('/database/export')
+def export_database():
+    """Stream a whole table for offline analysis, e.g.
+    /database/export?table=Results&format=ndjson. format is csv (default) or
+    ndjson. Rows are in primary key order; after=<key> starts after the
+    given primary key, e.g. to resume an interrupted download.
+    """
+    tables = {Table.__name__: Table for Table in commands.TABLES}
+    Table = tables.get(request.args.get('table', 'Results'))
+    export_format = request.args.get('format', 'csv')
+    if Table is None or export_format not in ['csv', 'ndjson']:
+        abort(400)
+
+    after = request.args.get('after')
+    if after is not None:
+        key, = Table.__table__.primary_key.columns
+        try:
+            after = key.type.python_type(after)
+        except ValueError:
+            abort(400)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f'{Table.__name__}.{export_format}'
+    return Response(stream_with_context(
+                        model.export_table(Table, export_format, after)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename={filename}'})
+
+
+@app.route('/predict', methods=['GET', 'POST'])
+@csrf.exempt
+def predict_races():
+    """Predict the outcome of upcoming races from current ratings, e.g.
+    /predict?racers=12150,9915,177974&top_k=3,10 for one start list, or a
+    POST of {"start_lists": [[12150, 9915], [177974, ...]], "top_k": [3]}
+    to predict many races at once. Returns {"races": [...]} with the
+    prediction for each start list (see prediction.predict_races).
+    """
+    try:
+        if request.method == 'POST':
+            body = request.get_json(force=True)
+            start_lists = body['start_lists']
+            top_k = body.get('top_k', [3])
+        else:
+            start_lists = [request.args['racers'].split(',')]
+            top_k = request.args.get('top_k', '3').split(',')
+        start_lists = [[int(racer_id) for racer_id in start_list]
+                       for start_list in start_lists]
+        top_k = [int(k) for k in top_k]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        abort(400)
+    if (len(start_lists) > prediction.MAX_START_LISTS
+            or any(len(start_list) > prediction.MAX_RACERS
+                   for start_list in start_lists)
+            or not all(1 <= k <= prediction.MAX_TOP_K for k in top_k)):
+        abort(400)
+
+    with phase('predict'):
+        races = prediction.predict_races(start_lists, top_k)
+    return jsonify({'races': races})
+
+
 @app.route('/evaluation')
 def accuracy():
-    plotting.make_hist()
-    plotting.make_corr_plot()
-    return render_template('evaluation.html')
+    metrics = plotting.make_evaluation_plots(Counters.get_cache_version())
+    return render_template('evaluation.html', metrics=metrics)
 
 @app.after_request
 def add_header(r):
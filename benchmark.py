@@ -0,0 +1,327 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import config
+import plotting
+import ratings
+import synthetic
+from database import db
+from model import (Races, Results, Racers, Checkpoints, RatingStats, Counters,
+                   RacerHistory, add_categories, get_racer_table)
+from preprocess import clean, clean_frame
+from search import SuggestionIndex
+
+BASELINE_PATH = os.path.join(config.basedir, 'benchmark_baseline.json')
+
+BENCHMARKS = {}  # name -> SimpleNamespace(setup, unit, database)
+
+
+def benchmark(name, unit, database=False):
+    """Register a benchmark. The decorated function takes the synthetic
+    data, does any setup that should not be timed, and returns a function
+    that runs the benchmark once and returns the number of units processed.
+    Benchmarks that use the database are only run if requested.
+    """
+    def register(setup):
+        BENCHMARKS[name] = SimpleNamespace(setup=setup, unit=unit,
+                                           database=database)
+        return setup
+    return register
+
+
+def get_categories(results):
+    """Placing results grouped by race category, each sorted by place."""
+    df = pd.DataFrame(results)
+    df = df[(df['IsDnf'] == 0) & (df['IsDNP'] == 0) & (df['IsDQ'] == 0)]
+    return [group.sort_values('Place')
+            for _, group in df.groupby(['race_id', 'RaceCategoryName'])]
+
+
+def with_priors(category, rng):
+    """Results for a category with random prior ratings."""
+    n = len(category)
+    return [SimpleNamespace(prior_mu=mu, prior_sigma=sigma)
+            for mu, sigma in zip(rng.normal(config.MU, config.SIGMA / 2, n),
+                                 rng.uniform(1, config.SIGMA, n))]
+
+
+@benchmark('preprocess.clean', 'rows')
+def bench_clean(data):
+    rows = [dict(row) for row in data.results]  # clean modifies rows
+    return lambda: len(list(clean(rows)))
+
+
+@benchmark('preprocess.clean_frame', 'rows')
+def bench_clean_frame(data):
+    def run():
+        clean_frame(data.results)
+        return len(data.results)
+    return run
+
+
+@benchmark('ratings.run_trueskill', 'races')
+def bench_run_trueskill(data):
+    rng = np.random.default_rng(0)
+    races = [with_priors(category, rng) for category in data.categories
+             if len(category) > 1]
+
+    def run():
+        for results in races:
+            ratings.run_trueskill(results, backend='numpy')
+        return len(races)
+    return run
+
+
+@benchmark('ratings.run_trueskill (mpmath)', 'races')
+def bench_run_trueskill_mpmath(data, num_races=100):
+    rng = np.random.default_rng(0)
+    races = [with_priors(category, rng) for category in data.categories
+             if len(category) > 1][:num_races]
+
+    def run():
+        for results in races:
+            ratings.run_trueskill(results, backend='mpmath')
+        return len(races)
+    return run
+
+
+@benchmark('search.SuggestionIndex (build)', 'names')
+def bench_index(data):
+    names = list({row['FirstName'] + ' ' + row['LastName']
+                  for row in data.results})
+    return lambda: len(SuggestionIndex(names))
+
+
+@benchmark('search.SuggestionIndex (search)', 'queries')
+def bench_search(data, num_queries=2000):
+    names = list({row['FirstName'] + ' ' + row['LastName']
+                  for row in data.results})
+    index = SuggestionIndex(names)
+    rng = np.random.default_rng(0)
+    queries = [names[i][j:j + k] for i, j, k in
+               zip(rng.integers(0, len(names), num_queries),
+                   rng.integers(0, 4, num_queries),
+                   rng.integers(1, 8, num_queries))]
+
+    def run():
+        for query in queries:
+            index.search(query)
+        return len(queries)
+    return run
+
+
+@benchmark('plotting.make_racer_plot', 'plots')
+def bench_racer_plot(data, num_racers=20):
+    df = pd.DataFrame(data.results)
+    races = pd.DataFrame(data.races).set_index('race_id')
+    df['date'] = pd.to_datetime(races['date'].reindex(df['race_id']).values)
+    df['num_racers'] = df.groupby(['race_id', 'RaceCategoryName'])['Place'] \
+                         .transform('size')
+    df.loc[df['IsDnf'] + df['IsDNP'] + df['IsDQ'] > 0, 'Place'] = None
+    rng = np.random.default_rng(0)
+    df['mu'] = rng.normal(config.MU, config.SIGMA / 2, len(df))
+    df['sigma'] = rng.uniform(1, config.SIGMA, len(df))
+    df['prior_mu'] = df['mu'] + rng.normal(0, 1, len(df))
+    df['prior_sigma'] = df['sigma'] + 0.1
+    cols = ['date', 'Place', 'num_racers', 'RaceName', 'prior_mu',
+            'prior_sigma', 'mu', 'sigma']
+    tables = [group.sort_values('date')[cols].to_dict('records')
+              for _, group in df.groupby('RacerID')]
+    tables = sorted(tables, key=len)[-num_racers:]  # most active racers
+
+    def run():
+        for table in tables:
+            plotting.make_racer_plot(table)
+        return len(tables)
+    return run
+
+
+@benchmark('import app', 'imports')
+def bench_import_app(data):
+    env = dict(os.environ)
+    env.setdefault('APP_SETTINGS', 'config.DevelopmentConfig')
+
+    def run():
+        # Each worker imports the app in a fresh interpreter
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=config.basedir,
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        return 1
+    return run
+
+
+def check_database():
+    """Returns True if the database may be used for benchmarks: it must be
+    empty or contain only synthetic data loaded by a previous benchmark,
+    since benchmarks delete all rows.
+    """
+    return not Results.count() or bool(Counters.get('synthetic_results'))
+
+
+def load_database(data):
+    """Replace the contents of the database with the synthetic data, unless
+    it is already loaded."""
+    if (Counters.get('synthetic_results') == len(data.results)
+            and Results.count() == data.num_cleaned):
+        return
+    for Table in [RacerHistory, Results, Racers, Races, Checkpoints,
+                  RatingStats, Counters]:
+        Table.query.delete()
+    db.session.commit()
+    Races.copy(data.races)
+    Results.copy(clean_frame(data.results))
+    add_categories()
+    Racers.add_table()
+    RacerHistory.add_table()
+    db.session.add(Counters(name='synthetic_results',
+                            value=len(data.results)))
+    db.session.commit()
+
+
+@benchmark('Model.add', 'rows', database=True)
+def bench_add(data, num_rows=20000):
+    load_database(data)
+    Results.query.delete()
+    db.session.commit()
+    rows = [row for row in clean(dict(row) for row in data.results[:num_rows])
+            if row]
+
+    def run():
+        Results.add(rows)
+        return len(rows)
+    return run
+
+
+@benchmark('Model.copy', 'rows', database=True)
+def bench_copy(data):
+    load_database(data)
+    Results.query.delete()
+    db.session.commit()
+    frame = clean_frame(data.results)
+
+    def run():
+        Results.copy(frame)
+        return len(frame)
+    return run
+
+
+@benchmark('ratings.get_all_ratings', 'results', database=True)
+def bench_get_all_ratings(data):
+    load_database(data)
+    ratings.reset_ratings()
+
+    def run():
+        ratings.get_all_ratings()
+        return data.num_cleaned
+    return run
+
+
+@benchmark('model.get_racer_table', 'queries', database=True)
+def bench_racer_table(data, num_queries=200):
+    load_database(data)
+    rng = np.random.default_rng(0)
+    racer_ids = [data.results[i]['RacerID']  # active racers more likely
+                 for i in rng.integers(0, len(data.results), num_queries)]
+
+    def run():
+        for racer_id in racer_ids:
+            get_racer_table(racer_id)
+        return len(racer_ids)
+    return run
+
+
+def get_data(scale=10000, seed=0):
+    """Synthetic data with about scale results for the benchmarks."""
+    races, results = synthetic.generate(scale, seed=seed)
+    return SimpleNamespace(races=races, results=results,
+                           categories=get_categories(results),
+                           num_cleaned=len(clean_frame(results)))
+
+
+def measure(bench, data, repeat=3):
+    """Run a benchmark repeat times and once more while tracing memory.
+    Returns the count of units processed, the best time in seconds,
+    throughput in units per second and peak traced memory in MB.
+    """
+    times = []
+    for _ in range(repeat):
+        run = bench.setup(data)
+        time0 = time.perf_counter()
+        count = run()
+        times.append(time.perf_counter() - time0)
+
+    run = bench.setup(data)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'count': count, 'seconds': min(times),
+            'throughput': count / min(times), 'peak_mb': peak / 2 ** 20}
+
+
+def run_benchmarks(scale=10000, seed=0, repeat=3, database=False, names=None,
+                   baseline_path=BASELINE_PATH, save_baseline=False,
+                   tolerance=0.2):
+    """Runs the benchmarks on synthetic data with about scale results and
+    prints throughput and peak memory for each, compared to the baseline
+    saved at baseline_path for the same scale. Benchmarks that use the
+    database are run only if database is True: they replace the contents of
+    the database with the synthetic data, so they refuse to run on a
+    database with real results in it.
+
+    Returns the names of benchmarks with throughput more than tolerance
+    below the baseline. If save_baseline, the results are saved as the new
+    baseline.
+    """
+    time0 = time.time()
+    data = get_data(scale, seed=seed)
+    print(f'Generated {len(data.races)} races and {len(data.results)} '
+          f'results: {time.time() - time0:.1f} s')
+
+    if database and not check_database():
+        raise RuntimeError('The database contains results that were not '
+                           'generated for benchmarks; use an empty database.')
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            saved = json.load(f)
+        if saved.get('scale') == scale and saved.get('seed') == seed:
+            baseline = saved['results']
+        else:
+            print(f'Baseline in {baseline_path} is for a different scale')
+
+    measured, regressions = {}, []
+    print(f'{"benchmark":<34}{"throughput":>22}{"peak MB":>10}'
+          f'{"vs baseline":>13}')
+    for name, bench in BENCHMARKS.items():
+        if (names and name not in names) or (bench.database and not database):
+            continue
+        result = measure(bench, data, repeat=repeat)
+        measured[name] = result
+
+        comparison = ''
+        if name in baseline:
+            ratio = result['throughput'] / baseline[name]['throughput']
+            comparison = f'{ratio:.2f}x'
+            if ratio < 1 - tolerance:
+                comparison += ' SLOWER'
+                regressions.append(name)
+        throughput = f'{result["throughput"]:,.1f} {bench.unit}/s'
+        print(f'{name:<34}{throughput:>22}{result["peak_mb"]:>10.1f}'
+              f'{comparison:>13}')
+
+    if save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({'scale': scale, 'seed': seed,
+                       'results': {**baseline, **measured}}, f, indent=2)
+        print(f'Saved baseline to {baseline_path}')
+    return regressions
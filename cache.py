@@ -0,0 +1,220 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import config
+
+
+class PageCache:
+    """On-disk cache of raw BikeReg pages keyed by URL path (e.g.
+    /race/11456). Page bodies are stored once per distinct content as
+    zlib-compressed files named by their SHA-256 digest, and a SQLite index
+    maps each path to its content along with when it was fetched and last
+    used. The least recently used pages are evicted to keep the compressed
+    size under max_bytes.
+    """
+
+    def __init__(self, directory=config.CACHE_DIR,
+                 max_bytes=config.CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+                             'path TEXT PRIMARY KEY, digest TEXT NOT NULL, '
+                             'fetched REAL NOT NULL, accessed REAL NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                             'digest TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def get(self, path, max_age=None):
+        """Get the cached text for path. Returns None if the path is not
+        cached or was fetched more than max_age seconds ago.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT digest, fetched FROM pages '
+                                   'WHERE path = ?', (path,)).fetchone()
+            if not row:
+                return None
+            digest, fetched = row
+            if max_age is not None and time.time() - fetched > max_age:
+                return None
+            try:
+                with open(self._blob_path(digest), 'rb') as f:
+                    data = zlib.decompress(f.read())
+            except (OSError, zlib.error):  # missing or corrupt - refetch
+                return None
+            with self._db:
+                self._db.execute('UPDATE pages SET accessed = ? '
+                                 'WHERE path = ?', (time.time(), path))
+        return data.decode('utf-8')
+
+    def put(self, path, text):
+        """Store the text for path, replacing any cached text."""
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            if not self._db.execute('SELECT 1 FROM blobs WHERE digest = ?',
+                                    (digest,)).fetchone():
+                blob = zlib.compress(data)
+                os.makedirs(os.path.dirname(self._blob_path(digest)),
+                            exist_ok=True)
+                with open(self._blob_path(digest), 'wb') as f:
+                    f.write(blob)
+                with self._db:
+                    self._db.execute('INSERT INTO blobs VALUES (?, ?)',
+                                     (digest, len(blob)))
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO pages '
+                                 'VALUES (?, ?, ?, ?)',
+                                 (path, digest, now, now))
+            self._evict()
+
+    def size(self):
+        """Total compressed size of the cached pages in bytes."""
+        size, = self._db.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM blobs').fetchone()
+        return size
+
+    def _evict(self):
+        """Drop least recently used pages, and content no longer used by
+        any page, until the cache fits in max_bytes.
+        """
+        while self.size() > self.max_bytes:
+            row = self._db.execute('SELECT path FROM pages '
+                                   'ORDER BY accessed LIMIT 1').fetchone()
+            with self._db:
+                if row:
+                    self._db.execute('DELETE FROM pages WHERE path = ?', row)
+                unused = self._db.execute(
+                    'SELECT digest FROM blobs WHERE digest NOT IN '
+                    '(SELECT digest FROM pages)').fetchall()
+                for digest, in unused:
+                    self._db.execute('DELETE FROM blobs WHERE digest = ?',
+                                     (digest,))
+                    os.remove(self._blob_path(digest))
+            if not row:
+                break
+
+
+class ComponentCache:
+    """Cache of computed page components (e.g. tables and plots) in two
+    tiers: an in-process LRU dictionary of up to maxsize values, backed by
+    an optional SQLite file at path that is shared by all workers on the
+    machine. Keys are tuples that should include everything the value
+    depends on, e.g. ('racer', racer_id, ratings_version). The shared store
+    keeps at most max_rows of the most recently stored values.
+    """
+
+    def __init__(self, maxsize=config.COMPONENT_CACHE_SIZE,
+                 path=config.COMPONENT_CACHE_PATH, max_rows=10000):
+        self.maxsize = maxsize
+        self.path = path
+        self.max_rows = max_rows
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._num_stored = 0
+
+    def _connect(self):
+        """SQLite connection for the shared store, opened lazily in each
+        worker process (connections must not be shared across a fork)."""
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=10,
+                                       check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS components ('
+                                 'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                                 'stored REAL NOT NULL)')
+            self._pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, value):
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Get the value for key, calling compute() to get it (and caching
+        it) if it is not in either tier."""
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+
+            if self.path:
+                row = self._connect().execute(
+                    'SELECT value FROM components WHERE key = ?',
+                    (repr(key),)).fetchone()
+                if row:
+                    value = pickle.loads(row[0])
+                    self._remember(key, value)
+                    return value
+
+        value = compute()
+
+        with self._lock:
+            self._remember(key, value)
+            if self.path:
+                self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        """Save the value in the shared store, occasionally dropping the
+        oldest values beyond max_rows."""
+        db = self._connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO components VALUES (?, ?, ?)',
+                       (repr(key), pickle.dumps(value), time.time()))
+            self._num_stored += 1
+            if self._num_stored % 100 == 0:
+                db.execute('DELETE FROM components WHERE key NOT IN '
+                           '(SELECT key FROM components '
+                           'ORDER BY stored DESC LIMIT ?)', (self.max_rows,))
+
+
+def serve(port=8000, directory=config.CACHE_DIR):
+    """Serve the cached pages over HTTP on localhost so that the scraper can
+    replay them without a network connection, e.g. with
+    SCRAPE_BASE_URL=http://localhost:8000. Uncached pages return 404.
+    """
+    page_cache = PageCache(directory)
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            text = page_cache.get(self.path)
+            if text is None:
+                self.send_error(404)
+                return
+            body = text.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json'
+                             if 'json=1' in self.path else 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('localhost', int(port)), ReplayHandler)
+    print(f'Serving cached pages from {directory} on port {port}...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,18 +1,52 @@
+import random
+
 import click
+import sqlalchemy as sa
 from database import db
-from model import Races, Results, Racers
+from model import (Races, Results, Racers, Checkpoints, RatingStats, Counters,
+                   RacerHistory)
+import ratings
+from cache import serve
+import query_plans
 from psycopg2.errors import UndefinedTable
 
-TABLES = [Races, Results, Racers]
+TABLES = [Races, Results, Racers, Checkpoints, RatingStats, Counters,
+          RacerHistory]
 
 
 def db_create_all(tables=TABLES):
-    """Creates specified tables. (Default: all tables)"""
+    """Creates specified tables (Default: all tables), and any of their
+    indexes that are missing from tables that already exist."""
+    bind = db.session.bind
     for Table in tables:
-        Table.__table__.create(db.session.bind, checkfirst=True)
+        Table.__table__.create(bind, checkfirst=True)
+        existing = {index['name'] for index in
+                    sa.inspect(bind).get_indexes(Table.__table__.name)}
+        for index in Table.__table__.indexes:
+            if index.name not in existing:
+                print(f'Creating index {index.name}...')
+                index.create(bind)
+    if Counters in tables and not Counters.get('database_token'):
+        # Identifies this database in cache keys (Counters.get_cache_version)
+        Counters.set('database_token', random.getrandbits(62))
+        db.session.commit()
 
 def db_drop_all(tables=TABLES):
-    """Drops specified tables (Default: all tables)"""
+    """Drops specified tables (Default: all tables). Dropping any of Races,
+    Results or Racers also empties RacerHistory and RatingStats and clears
+    the ratings checkpoint, which are derived from them and would otherwise
+    describe results that are gone (e.g. a resumed rating pass would skip
+    re-added results up to the old checkpoint)."""
+    if {Races, Results, Racers} & set(tables):
+        existing = set(sa.inspect(db.session.bind).get_table_names())
+        for Table in [RacerHistory, RatingStats, Checkpoints]:
+            if Table in tables or Table.__table__.name not in existing:
+                continue
+            if Table is Checkpoints:
+                Checkpoints.clear('ratings')
+            else:
+                Table.query.delete()
+        db.session.commit()
     for Table in tables:
         try:
             Table.__table__.drop(db.session.bind, checkfirst=True)
@@ -20,7 +54,119 @@ def db_drop_all(tables=TABLES):
             print(e)
             pass # table probably doesn't exist for some reason
 
+@click.option('--no-cluster', is_flag=True)
+def build_racer_history(no_cluster=False):
+    """Adds results missing from the RacerHistory table and clusters it by
+    racer and date (locking it while it is rewritten) unless
+    --no-cluster."""
+    RacerHistory.add_table(cluster=not no_cluster)
+
+@click.option('--num-races', default=100)
+@click.option('--max-racers', default=100)
+@click.option('--seed', default=0)
+@click.option('--tolerance', default=1e-3)
+def check_backends(num_races=100, max_racers=100, seed=0, tolerance=1e-3):
+    """Exits with an error if the numpy and mpmath rating backends differ by
+    more than tolerance in any mu or sigma on num_races random races of up
+    to max_racers racers (see ratings.check_backends)."""
+    if ratings.check_backends(num_races, max_racers, seed) > tolerance:
+        raise SystemExit(1)
+
+@click.option('--port', default=8000)
+def serve_cache(port=8000):
+    """Serves cached BikeReg pages on localhost for offline scraping."""
+    serve(port)
+
+@click.option('--scale', default=10000)
+@click.option('--seed', default=0)
+@click.option('--repeat', default=3)
+@click.option('--database', is_flag=True)
+@click.option('--save-baseline', is_flag=True)
+def benchmark(scale=10000, seed=0, repeat=3, database=False,
+              save_baseline=False):
+    """Benchmarks hot paths on synthetic data with about scale results.
+    Exits with an error if any benchmark is slower than the saved baseline.
+    --database also benchmarks the database, replacing its contents."""
+    from benchmark import run_benchmarks  # imports plotting, pandas, ...
+    if run_benchmarks(scale=scale, seed=seed, repeat=repeat,
+                      database=database, save_baseline=save_baseline):
+        raise SystemExit(1)
+
+@click.option('--seed', is_flag=True)
+@click.option('--scale', default=10000)
+def check_query_plans(seed=False, scale=10000):
+    """Exits with an error if any hot query cannot use an index (see
+    query_plans.check_query_plans). --seed first fills an empty database
+    with about scale synthetic results."""
+    if seed:
+        import benchmark
+        if not benchmark.check_database():
+            raise click.ClickException('The database already contains '
+                                       'results; seed an empty database.')
+        benchmark.load_database(benchmark.get_data(scale))
+    if query_plans.check_query_plans():
+        raise SystemExit(1)
+
+@click.option('--seed', is_flag=True)
+@click.option('--scale', default=10000)
+@click.option('--processes', default=4)
+@click.option('--chunk-size', default=7)
+def check_resume(seed=False, scale=10000, processes=4, chunk_size=7):
+    """Exits with an error if a parallel rating run that crashes and
+    resumes gives different ratings than a serial run (see
+    ratings.check_resume). Replaces all ratings, so --seed first fills an
+    empty database with about scale synthetic results."""
+    if seed:
+        import benchmark
+        if not benchmark.check_database():
+            raise click.ClickException('The database already contains '
+                                       'results; seed an empty database.')
+        benchmark.load_database(benchmark.get_data(scale))
+    if ratings.check_resume(processes=processes, chunk_size=chunk_size):
+        raise SystemExit(1)
+
+@click.option('--full', is_flag=True)
+def export_snapshot(full=False):
+    """Exports Results, Races and Racers to a columnar snapshot (see
+    snapshot.export). Only adds results from new race categories unless
+    --full."""
+    import snapshot  # imports pandas
+    snapshot.export(append=not full)
+
+@click.option('--export', is_flag=True)
+def replay_ratings(export=False):
+    """Re-rates all results in memory from the columnar snapshot and writes
+    the ratings to the database in one pass (see replay.replay_ratings).
+    --export first adds new results to the snapshot."""
+    import replay  # imports pandas
+    try:
+        replay.replay_ratings(export=export)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+@click.option('--beta', multiple=True, type=float)
+@click.option('--tau', multiple=True, type=float)
+@click.option('--sigma', multiple=True, type=float)
+@click.option('--processes', default=None, type=int)
+@click.option('--sort-by', default='mean_spearman')
+def sweep_ratings(beta=(), tau=(), sigma=(), processes=None,
+                  sort_by='mean_spearman'):
+    """Rates the snapshot with every combination of the TrueSkill
+    parameters (each option may be repeated; Default: a grid around the
+    current parameters) in parallel and writes a ranked report (see
+    sweep.run_sweep)."""
+    import sweep  # imports pandas
+    try:
+        sweep.run_sweep(betas=beta or sweep.BETAS, taus=tau or sweep.TAUS,
+                        sigmas=sigma or sweep.SIGMAS, processes=processes,
+                        sort_by=sort_by)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
 def init_app(app):
     # add multiple commands in a bulk
-    for command in [db_create_all, db_drop_all]:
+    for command in [db_create_all, db_drop_all, build_racer_history,
+                    check_backends, serve_cache, benchmark,
+                    check_query_plans, check_resume, export_snapshot,
+                    replay_ratings, sweep_ratings]:
         app.cli.add_command(app.cli.command()(command))
@@ -5,6 +5,47 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 MU = 25
 SIGMA = 25/3
 
+# TrueSkill engine used by ratings.run_trueskill: 'numpy' (fast, float64,
+# falls back to mpmath on floating point errors) or 'mpmath'
+RATING_BACKEND = os.environ.get('RATING_BACKEND', 'numpy')
+
+# Number of processes used to rate independent race categories in parallel
+RATING_PROCESSES = int(os.environ.get('RATING_PROCESSES', 1))
+
+# Scraping: where to get BikeReg pages (e.g. a local cache.serve replay
+# server) and where to cache them on disk
+SCRAPE_BASE_URL = os.environ.get('SCRAPE_BASE_URL',
+                                 'https://results.bikereg.com')
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(basedir, 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Seconds before a cached page is downloaded again, since BikeReg pages can
+# be corrected after they are first posted
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', 30 * 24 * 3600))
+
+# Columnar snapshot of the results dataset (see snapshot.py)
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(basedir, 'snapshot'))
+
+# Cached page components: number kept in memory per worker, and the SQLite
+# file shared by the workers on a machine (empty to disable)
+COMPONENT_CACHE_SIZE = int(os.environ.get('COMPONENT_CACHE_SIZE', 256))
+COMPONENT_CACHE_PATH = os.environ.get('COMPONENT_CACHE_PATH',
+                                      os.path.join(CACHE_DIR,
+                                                   'components.sqlite'))
+
+# Seconds before search suggestion indexes are rebuilt from the database
+SEARCH_INDEX_TTL = int(os.environ.get('SEARCH_INDEX_TTL', 3600))
+
+# Races rows cached per worker, and seconds before they are reloaded
+RACE_CACHE_SIZE = int(os.environ.get('RACE_CACHE_SIZE', 1024))
+RACE_CACHE_TTL = int(os.environ.get('RACE_CACHE_TTL', 3600))
+
+# Seconds before the race and racer IDs used to validate requests are
+# reloaded from the database
+ID_CACHE_TTL = int(os.environ.get('ID_CACHE_TTL', 3600))
+
+# Requests slower than this many seconds are logged with their slowest query
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1))
+
 class Config(object):
     DEBUG = False
     TESTING = False
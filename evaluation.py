@@ -1,34 +1,87 @@
 import numpy as np
+import pandas as pd
 
-from sqlalchemy import func
+from database import db
+from model import Racers, Races, Results, RatingStats
 
-from scipy.stats import spearmanr
+def get_placings():
+    """Get race_id, RaceCategoryName, Place, prior_mu and predicted_place
+    for every placing (non-DNF) result as columns of a DataFrame."""
+    query = (Results.query
+                    .filter(Results.Place != None)
+                    .with_entities(Results.race_id,
+                                   Results.RaceCategoryName,
+                                   Results.Place,
+                                   Results.prior_mu,
+                                   Results.predicted_place))
+    return pd.read_sql(query.statement, db.engine)
+
+
+def get_metrics(placings=None, min_racers=5, top_k=(1, 3, 10)):
+    """Calculates the Spearman correlation between place and prior rating for
+    each race category with at least min_racers placing racers, along with
+    the top-k accuracy of the predicted places: the fraction of the top k
+    finishers that were predicted to finish in the top k, averaged over race
+    categories. All groups are computed at once from the columns of
+    placings (Default: get_placings()).
+
+    Returns an array of correlations and a dictionary of summary metrics.
+    """
+    if placings is None:
+        placings = get_placings()
+    df = placings.copy()
+    df['group'] = df.groupby(['race_id', 'RaceCategoryName']).ngroup()
+    df = df[df.groupby('group')['Place'].transform('size') >= min_racers]
+    groups = df.groupby('group')
+
+    # Spearman correlation = Pearson correlation of the (average) ranks
+    x = groups['Place'].rank()
+    y = groups['prior_mu'].rank()
+    moments = pd.DataFrame({'x': x, 'y': y, 'xy': x * y, 'xx': x ** 2,
+                            'yy': y ** 2, 'group': df['group']}) \
+                .groupby('group').mean()
+    cov = moments['xy'] - moments['x'] * moments['y']
+    var_x = moments['xx'] - moments['x'] ** 2
+    var_y = moments['yy'] - moments['y'] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = (cov / np.sqrt(var_x * var_y)).to_numpy()
+    correlations = correlations[np.isfinite(correlations)]
+
+    metrics = {'num_categories': int(groups.ngroups),
+               'mean_spearman': float(np.mean(correlations))
+                                if len(correlations) else None,
+               'median_spearman': float(np.median(correlations))
+                                  if len(correlations) else None}
+    sizes = groups.size()
+    for k in top_k:
+        hits = ((df['Place'] <= k) & (df['predicted_place'] <= k)) \
+                 .groupby(df['group']).sum()
+        metrics[f'top_{k}_accuracy'] = float((hits / np.minimum(sizes, k))
+                                             .mean()) if len(sizes) else None
+    return correlations, metrics
 
-from model import Racers, Races, Results
 
 def correlation(min_racers=5):
     """Calculates the Spearman correlation for races with the given minimum
     number of racers."""
-
-    results = Results.query \
-                     .filter(Results.Place != None) \
-                     .with_entities(Results.RaceName,
-                                    Results.RaceCategoryName,
-                                    func.array_agg(Results.Place),
-                                    func.array_agg(Results.prior_mu)) \
-                     .group_by(Results.RaceName, Results.RaceCategoryName)
-
     print('Calculating Spearman correlation...')
-    correlations = []
-    for name, category, places, mus in results:
-        if len(places) >= min_racers:
-            correlations.append(spearmanr(places, mus).correlation)
+    correlations, _ = get_metrics(min_racers=min_racers)
     print('Done calculating Spearman correlation!')
 
-    return correlations
+    return list(correlations)
 
 
 def get_mean_ratings():
     """Get all mean ratings."""
     racers = Racers.query.filter(Racers.mu != 25).all()
     return [racer.mu for racer in racers]
+
+
+def get_rating_histogram():
+    """Get the histogram of mean ratings of rated racers as (bin edges,
+    counts), from the RatingStats kept by the rating pass if available."""
+    stats = RatingStats.load()
+    if stats:
+        return RatingStats.BIN_EDGES, stats.histogram
+    counts, edges = np.histogram(get_mean_ratings(), bins=30)
+    return edges, counts
@@ -0,0 +1,106 @@
+import numpy as np
+
+# Convergence threshold used by the trueskill package for its schedule
+MIN_DELTA = 0.0001
+
+LOG_SQRT_2PI = 0.5 * np.log(2 * np.pi)
+
+
+def rate(mus, sigmas, beta, tau, min_delta=MIN_DELTA, max_iter=None):
+    """Rates one free-for-all race with no draws, where racers are given in
+    finishing order (winner first) by their prior mus and sigmas. Returns
+    arrays of updated mus and sigmas.
+
+    This is the same factor graph the trueskill package builds for a race of
+    one-person teams, but the messages for every racer and every pair of
+    neighboring finishers are passed at once as float64 arrays. Raises
+    FloatingPointError if the update is numerically unstable so the caller
+    can fall back to an arbitrary-precision backend.
+    """
+    from scipy.special import log_ndtr  # slow to import; only needed here
+    mus = np.asarray(mus, dtype=np.float64)
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    n = len(mus)
+    if n < 2:
+        raise ValueError('Need at least two racers to rate a race.')
+    if max_iter is None:
+        # Information moves one place along the finishing order per sweep, so
+        # allow enough sweeps to cross the whole field
+        max_iter = 10 + 2 * n
+
+    with np.errstate(all='raise'):
+        # Skill prior (including dynamics) and performance messages in
+        # natural parameters (precision pi, precision-adjusted mean tau)
+        skill_var = sigmas ** 2 + tau ** 2
+        perf_pi = 1 / (skill_var + beta ** 2)
+        perf_tau = perf_pi * mus
+
+        # Messages from each truncation factor to its difference variable,
+        # d_k = t_k - t_{k+1} > 0
+        trunc_pi = np.zeros(n - 1)
+        trunc_tau = np.zeros(n - 1)
+        # Messages from each difference factor up to its left/right variable
+        left_pi, left_tau = np.zeros(n - 1), np.zeros(n - 1)
+        right_pi, right_tau = np.zeros(n - 1), np.zeros(n - 1)
+
+        for _ in range(max_iter):
+            # Marginal of each performance variable
+            pi = perf_pi.copy()
+            pi[:-1] += left_pi
+            pi[1:] += right_pi
+            tau_ = perf_tau.copy()
+            tau_[:-1] += left_tau
+            tau_[1:] += right_tau
+
+            # Cavity distributions excluding each difference factor
+            cav_left_var = 1 / (pi[:-1] - left_pi)
+            cav_left_mu = (tau_[:-1] - left_tau) * cav_left_var
+            cav_right_var = 1 / (pi[1:] - right_pi)
+            cav_right_mu = (tau_[1:] - right_tau) * cav_right_var
+
+            # Message down to each difference variable
+            down_pi = 1 / (cav_left_var + cav_right_var)
+            down_tau = down_pi * (cav_left_mu - cav_right_mu)
+
+            # Truncation update (win with no draw margin)
+            sqrt_pi = np.sqrt(down_pi)
+            x = down_tau / sqrt_pi
+            v = np.exp(-0.5 * x ** 2 - LOG_SQRT_2PI - log_ndtr(x))
+            w = v * (v + x)
+            if not np.all((w > 0) & (w < 1)):
+                raise FloatingPointError('w is out of bounds')
+            marg_pi = down_pi / (1 - w)
+            marg_tau = (down_tau + sqrt_pi * v) / (1 - w)
+
+            new_trunc_pi = marg_pi - down_pi
+            new_trunc_tau = marg_tau - down_tau
+            delta = max(np.max(np.abs(new_trunc_tau - trunc_tau)),
+                        np.sqrt(np.max(np.abs(new_trunc_pi - trunc_pi))))
+            trunc_pi, trunc_tau = new_trunc_pi, new_trunc_tau
+
+            # Messages back up to the left (t_k = d_k + t_{k+1}) and right
+            # (t_{k+1} = t_k - d_k) variables of each difference factor
+            trunc_var = 1 / trunc_pi
+            trunc_mu = trunc_tau * trunc_var
+            left_pi = 1 / (trunc_var + cav_right_var)
+            left_tau = left_pi * (trunc_mu + cav_right_mu)
+            right_pi = 1 / (trunc_var + cav_left_var)
+            right_tau = right_pi * (cav_left_mu - trunc_mu)
+
+            if delta <= min_delta:
+                break
+
+        # Combined message from the race to each performance variable, sent
+        # up through the performance noise to each skill variable
+        like_pi = np.zeros(n)
+        like_pi[:-1] += left_pi
+        like_pi[1:] += right_pi
+        like_tau = np.zeros(n)
+        like_tau[:-1] += left_tau
+        like_tau[1:] += right_tau
+        a = 1 / (1 + beta ** 2 * like_pi)
+
+        post_pi = 1 / skill_var + a * like_pi
+        post_tau = mus / skill_var + a * like_tau
+
+    return post_tau / post_pi, np.sqrt(1 / post_pi)
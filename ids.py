@@ -0,0 +1,53 @@
+import time
+
+import numpy as np
+
+import config
+from model import Races, Racers
+
+
+class IdSet:
+    """Sorted array of distinct integer IDs for fast membership tests and
+    random valid IDs."""
+
+    def __init__(self, ids):
+        self.ids = np.unique(np.fromiter(ids, dtype=np.int64))
+        self._rng = np.random.default_rng()
+
+    def __contains__(self, id_):
+        i = np.searchsorted(self.ids, id_)
+        return i < len(self.ids) and self.ids[i] == id_
+
+    def __len__(self):
+        return len(self.ids)
+
+    def random(self):
+        """Returns a random ID from the set."""
+        return int(self._rng.choice(self.ids))
+
+
+LOADERS = {'race_id': lambda: (x for x, in Races.query
+                                               .with_entities(Races.race_id)),
+           'RacerID': lambda: (x for x, in Racers.query
+                                                 .with_entities(Racers.RacerID))}
+
+_id_sets = {}  # column -> (IdSet, time loaded)
+
+
+def get_ids(col):
+    """Get the IdSet for the given column ('race_id' or 'RacerID'), loading
+    it from the database if needed. IDs are reloaded after
+    config.ID_CACHE_TTL seconds so that workers pick up new races and racers
+    added elsewhere.
+    """
+    id_set, loaded = _id_sets.get(col, (None, 0))
+    if id_set is None or time.time() - loaded > config.ID_CACHE_TTL:
+        id_set = IdSet(LOADERS[col]())
+        _id_sets[col] = (id_set, time.time())
+    return id_set
+
+
+def refresh():
+    """Forget the loaded IDs so they are reloaded on next use, e.g. after
+    adding races or racers."""
+    _id_sets.clear()
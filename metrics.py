@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, float('inf'))
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint and '
+                                       'status.'),
+    'http_request_seconds': ('histogram', 'Request latency by endpoint.'),
+    'http_request_phase_seconds': ('histogram', 'Time spent in each phase of '
+                                                'a request, by endpoint.'),
+    'http_request_sql_statements': ('histogram', 'SQL statements executed '
+                                                 'per request, by endpoint.'),
+    'sql_statements_total': ('counter', 'SQL statements executed.'),
+    'sql_statement_seconds': ('histogram', 'SQL statement latency.'),
+    'rating_categories_total': ('counter', 'Race categories rated.'),
+    'rating_results_total': ('counter', 'Results rated.'),
+    'rating_commit_seconds': ('histogram', 'Time to commit a chunk of '
+                                           'ratings.'),
+    'rating_categories_per_second': ('gauge', 'Categories rated per second '
+                                              'in the current or last run.'),
+    'rating_results_per_second': ('gauge', 'Results rated per second in the '
+                                           'current or last run.'),
+    'ingest_rows_total': ('counter', 'Rows added to each table.'),
+    'ingest_seconds': ('histogram', 'Time to write a batch of rows, by '
+                                    'table.'),
+    'ingest_rows_per_second': ('gauge', 'Rows added per second in the '
+                                        'current or last run, by table.'),
+    'app_startup_seconds': ('gauge', 'Time to import and set up the app.'),
+    'app_first_request_seconds': ('gauge', 'Latency of the first request '
+                                           'handled by this process.'),
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms for this process, rendered in the
+    Prometheus text format. Each metric is identified by its name and
+    labels, e.g. metrics.inc('ingest_rows_total', 1000, table='Results').
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> value for counters and gauges
+        self._histograms = {}  # (name, labels) -> (buckets, counts, sum)
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=BUCKETS, **labels):
+        """Add an observation (e.g. a duration in seconds) to a histogram
+        with the given bucket upper bounds."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, counts, total = self._histograms.get(
+                key, (buckets, [0] * len(buckets), 0))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._histograms[key] = (buckets, counts, total + value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in a with block in a histogram."""
+        time0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - time0, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        def format_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', r'\"'))
+                                  for k, v in labels) + '}'
+
+        by_name = defaultdict(list)
+        with self._lock:
+            for (name, labels), value in sorted(self._values.items(),
+                                                key=str):
+                by_name[name].append(f'{name}{format_labels(labels)} {value}')
+            for (name, labels), (buckets, counts, total) in sorted(
+                    self._histograms.items(), key=str):
+                for bound, count in zip(buckets, counts):
+                    le = '+Inf' if bound == float('inf') else bound
+                    by_name[name].append(
+                        f'{name}_bucket{format_labels(labels, le=le)} {count}')
+                by_name[name].append(f'{name}_sum{format_labels(labels)} '
+                                     f'{total}')
+                by_name[name].append(f'{name}_count{format_labels(labels)} '
+                                     f'{counts[-1]}')
+
+        lines = []
+        for name in sorted(by_name):
+            kind, text = HELP.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(by_name[name])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the current request, e.g. with phase('render'). The
+    phases are reported in the Server-Timing header and in the
+    http_request_phase_seconds histogram."""
+    time0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - time0
+        if has_request_context():
+            g.phases.append((name, elapsed))
+            metrics.observe('http_request_phase_seconds', elapsed,
+                            endpoint=request.endpoint, phase=name)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    record_statement(statement,
+                     time.perf_counter() - conn.info['query_start'].pop())
+
+
+def record_statement(statement, elapsed):
+    """Record a SQL statement that took elapsed seconds. Called for every
+    statement SQLAlchemy runs, and directly for statements run on a DBAPI
+    cursor (e.g. COPY), which its events miss."""
+    metrics.inc('sql_statements_total')
+    metrics.observe('sql_statement_seconds', elapsed)
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+        if elapsed > g.slowest_sql[0]:
+            g.slowest_sql = (elapsed, statement)
+
+
+_first_request_done = False
+
+
+def _before_request():
+    g.request_start = time.perf_counter()
+    g.phases = []
+    g.sql_count = 0
+    g.sql_time = 0
+    g.slowest_sql = (0, None)
+
+
+def _after_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    metrics.inc('http_requests_total', endpoint=endpoint,
+                status=response.status_code)
+    metrics.observe('http_request_seconds', elapsed, endpoint=endpoint)
+    global _first_request_done
+    if not _first_request_done:
+        _first_request_done = True
+        metrics.set('app_first_request_seconds', elapsed)
+    metrics.observe('http_request_sql_statements', g.sql_count,
+                    buckets=COUNT_BUCKETS, endpoint=endpoint)
+
+    timings = [f'{name};dur={1000 * seconds:.1f}'
+               for name, seconds in g.phases]
+    timings.append(f'db;desc="{g.sql_count} queries";'
+                   f'dur={1000 * g.sql_time:.1f}')
+    timings.append(f'total;dur={1000 * elapsed:.1f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    if elapsed > config.SLOW_REQUEST_SECONDS:
+        seconds, statement = g.slowest_sql
+        print(f'Slow request {request.full_path}: {elapsed:.3f} s, '
+              f'{g.sql_count} queries taking {g.sql_time:.3f} s; '
+              f'phases {g.phases}; slowest query ({seconds:.3f} s): '
+              f'{statement}')
+    return response
+
+
+def init_app(app):
+    """Record request metrics for the app and serve them at /metrics."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -1,10 +1,14 @@
-import dill
+import csv
 import glob
+import io
+import json
+import math
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
-import pandas as pd
 
 import sqlalchemy as sa
 from sqlalchemy import update, func
@@ -13,10 +17,13 @@ from wtforms.validators import ValidationError
 
 from database import db
 
-from preprocess import clean
-import scraping
+from metrics import metrics, record_statement
 import config
 
+# pandas (with preprocess) and aiohttp (with scraping) are slow to import and
+# only needed to add data, so they are imported in the methods that add data
+# instead of when each web worker starts.
+
 class Model:
     def __init__(self, **entries):
         """Custom init to ignore keyword arguments not in the table schema."""
@@ -34,14 +41,130 @@ class Model:
                    for row in filter(lambda x: x, rows)] # filter empty rows
         objs = cls.drop_duplicates(objs)
 
-        db.session.add_all(objs)
-        db.session.commit()
+        with metrics.timer('ingest_seconds', table=cls.__name__):
+            db.session.add_all(objs)
+            db.session.commit()
+        metrics.inc('ingest_rows_total', len(objs), table=cls.__name__)
+        return len(objs)
+
+    @classmethod
+    def copy(cls, rows):
+        """Add rows to the table like add, but stream them into the database
+        with PostgreSQL COPY through a temporary staging table. Rows whose
+        primary key is repeated in rows or already in the table are skipped.
+        rows may also be a DataFrame, which is written without iterating over
+        its rows. Returns the number of rows added.
+        """
+        import pandas as pd
+        cols = cls.get_columns()
+        defaults = {col.name: col.default for col in cls.__table__.columns
+                    if col.default is not None}
+
+        if isinstance(rows, pd.DataFrame):
+            frame = rows.reindex(columns=cols)
+            for col in cls.__table__.columns:
+                default = defaults.get(col.name)
+                if default is not None and not default.is_callable:
+                    frame[col.name] = frame[col.name].fillna(default.arg)
+                if isinstance(col.type, sa.Integer):
+                    frame[col.name] = frame[col.name].astype('Int64')
+            buffer = io.StringIO()
+            frame.to_csv(buffer, header=False, index=False, na_rep=r'\N')
+            buffer.seek(0)
+            return cls._copy_buffer(buffer, cols)
+
+        def copy_value(col, value):
+            """Format value for a CSV COPY, filling in column defaults the
+            same way the ORM does for missing values."""
+            if value is None and col in defaults:
+                default = defaults[col]
+                value = default.arg(None) if default.is_callable else default.arg
+            if value is None:
+                return r'\N'
+            if isinstance(value, (list, tuple)):  # PostgreSQL array literal
+                return '{' + ','.join('"{}"'.format(str(x).replace('\\', '\\\\')
+                                                          .replace('"', '\\"'))
+                                      for x in value) + '}'
+            return value
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in filter(lambda x: x, rows):  # filter empty rows
+            if not isinstance(row, dict):
+                row = row.__dict__
+            writer.writerow([copy_value(col, row.get(col)) for col in cols])
+        buffer.seek(0)
+        return cls._copy_buffer(buffer, cols)
+
+    @classmethod
+    def _copy_buffer(cls, buffer, cols):
+        """COPY CSV rows with the given columns from buffer into the table,
+        skipping repeated and existing primary keys, and commit. Returns the
+        number of rows added.
+        """
+        table = cls.__table__.name
+        key, = cls.__table__.primary_key.columns.keys()
+        col_list = ', '.join(f'"{col}"' for col in cols)
+        with metrics.timer('ingest_seconds', table=cls.__name__):
+            connection = db.session.connection()
+            connection.execute(f'CREATE TEMP TABLE "{table}_staging" '
+                               f'(LIKE "{table}") ON COMMIT DROP')
+            copy_from(connection,
+                      f'COPY "{table}_staging" ({col_list}) '
+                      r"FROM STDIN WITH (FORMAT csv, NULL '\N')", buffer)
+            num_rows = connection.execute(
+                f'INSERT INTO "{table}" ({col_list}) '
+                f'SELECT DISTINCT ON ("{key}") {col_list} '
+                f'FROM "{table}_staging" '
+                f'ON CONFLICT ("{key}") DO NOTHING').rowcount
+            db.session.commit()
+        metrics.inc('ingest_rows_total', num_rows, table=cls.__name__)
+        return num_rows
+
+    @classmethod
+    def copy_update(cls, frame, commit=True):
+        """Update rows of the table like update, from a DataFrame with the
+        primary key and the columns to set, but stream the new values into
+        the database with PostgreSQL COPY and apply them with a single
+        UPDATE. Columns of frame that are not in the table are ignored.
+        Returns the number of rows updated.
+        """
+        table = cls.__table__.name
+        key, = cls.__table__.primary_key.columns.keys()
+        cols = [col for col in cls.get_columns()
+                if col in frame.columns and col != key]
+        buffer = io.StringIO()
+        frame[[key] + cols].to_csv(buffer, header=False, index=False,
+                                   na_rep=r'\N')
+        buffer.seek(0)
+
+        col_list = ', '.join(f'"{col}"' for col in [key] + cols)
+        assignments = ', '.join(f'"{col}" = u."{col}"' for col in cols)
+        connection = db.session.connection()
+        connection.execute(f'CREATE TEMP TABLE "{table}_updates" '
+                           f'(LIKE "{table}") ON COMMIT DROP')
+        copy_from(connection,
+                  f'COPY "{table}_updates" ({col_list}) '
+                  r"FROM STDIN WITH (FORMAT csv, NULL '\N')", buffer)
+        num_rows = connection.execute(
+            f'UPDATE "{table}" SET {assignments} '
+            f'FROM "{table}_updates" u '
+            f'WHERE "{table}"."{key}" = u."{key}"').rowcount
+        if commit:
+            db.session.commit()
+        return num_rows
 
     @classmethod
     def count(cls):
         """Returns a count of the rows in the table."""
         return cls.query.count()
 
+    @classmethod
+    def save_count(cls):
+        """Save the number of rows in the table as a counter (e.g.
+        'Results_rows') for get_table_counts. Does not commit."""
+        Counters.set(f'{cls.__name__}_rows', cls.count())
+
     @classmethod
     def drop_duplicates(cls, rows):
         """Check list of row objects duplicate index and return list of row
@@ -68,6 +191,28 @@ class Model:
         """Get the column names for the table."""
         return list(cls.__table__.columns.keys())
 
+    @classmethod
+    def iter_batches(cls, batch_size=10000, after=None):
+        """Yield every row of the table as tuples of column values (in the
+        order of get_columns), batch_size rows at a time in primary key
+        order, starting after the primary key after if given. Each batch is
+        a separate query for the rows following the last key of the previous
+        batch (keyset pagination), so any table can be read with constant
+        memory and without slow OFFSETs.
+        """
+        key, = cls.__table__.primary_key.columns
+        cols = list(cls.__table__.columns)
+        key_index = cols.index(key)
+        while True:
+            query = db.session.query(*cols).order_by(key)
+            if after is not None:
+                query = query.filter(key > after)
+            rows = query.limit(batch_size).all()
+            if not rows:
+                return
+            yield rows
+            after = rows[-1][key_index]
+
     @classmethod
     def get_sample(cls, limit, start=0):
         """Get the first `limit` rows of the table starting at index start.
@@ -102,6 +247,76 @@ class Model:
             db.session.commit()
 
 
+def copy_from(connection, statement, buffer):
+    """Run a COPY ... FROM STDIN statement on a SQLAlchemy connection, reading
+    from buffer. COPY needs the DBAPI cursor, which SQLAlchemy's statement
+    events (and so the SQL metrics) don't see, so it is recorded here."""
+    time0 = time.perf_counter()
+    connection.connection.cursor().copy_expert(statement, buffer)
+    record_statement(statement, time.perf_counter() - time0)
+
+
+def name_date(race):
+    """Name and date of a race (a dictionary of Races columns) as shown on
+    the website, e.g. 'Tour of Somerville (2019-05-27)'."""
+    return '{} ({})'.format(race['name'], race['date'].strftime('%Y-%m-%d'))
+
+
+class RaceCache:
+    """Least recently used cache of up to maxsize Races rows (dictionaries)
+    by race_id, which also resolves name_date strings to race_ids. Rows are
+    reloaded after ttl seconds so that workers pick up new categories.
+    """
+
+    def __init__(self, maxsize=config.RACE_CACHE_SIZE,
+                 ttl=config.RACE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._races = OrderedDict()  # race_id -> (row, time loaded)
+        self._ids = {}  # name_date -> race_id for cached races
+        self._lock = threading.Lock()
+
+    def get(self, race_id):
+        """Get the cached row for race_id, or None."""
+        with self._lock:
+            entry = self._races.get(race_id)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            self._races.move_to_end(race_id)
+            return entry[0]
+
+    def get_id(self, name_date):
+        """Get the race_id of the cached race with name_date, or None."""
+        race_id = self._ids.get(name_date)
+        return race_id if self.get(race_id) else None
+
+    def add(self, row):
+        """Cache a row (a keyed tuple of Races columns) from a query and
+        return it as a dictionary. Returns None if row is None.
+        """
+        if row is None:
+            return None
+        race = row._asdict()
+        with self._lock:
+            self._races[race['race_id']] = (race, time.time())
+            self._races.move_to_end(race['race_id'])
+            if race['date']:
+                self._ids[name_date(race)] = race['race_id']
+            while len(self._races) > self.maxsize:
+                _, (old, _) = self._races.popitem(last=False)
+                if old['date']:
+                    self._ids.pop(name_date(old), None)
+        return race
+
+    def clear(self):
+        with self._lock:
+            self._races.clear()
+            self._ids.clear()
+
+
+race_cache = RaceCache()
+
+
 class Races(Model, db.Model):
     race_id = db.Column(db.Integer, primary_key=True)
     index = synonym('race_id')
@@ -114,65 +329,111 @@ class Races(Model, db.Model):
     categories = db.Column(db.ARRAY(db.String), default=list)
     num_racers = db.Column(db.ARRAY(db.Integer), default=list) # number of races per category
 
+    __table_args__ = (
+        # Race lookups by name and date (get_race_id, validator)
+        db.Index('ix_races_name_date', 'name', 'date'),
+        # Races in rating order (get_all_ratings)
+        db.Index('ix_races_date_race_id', 'date', 'race_id'),
+    )
+
     def __repr__(self):
         return f"Race: {self.race_id, self.name}"
 
     @classmethod
-    def add_table(cls, race_ids=list(range(1, 13000))):
+    def add_table(cls, race_ids=list(range(1, 13000)), bulk=True,
+                  batch_size=1000):
+        """Add races with the given race_ids by scraping their BikeReg race
+        pages. If bulk, rows are added batch_size at a time with COPY (see
+        Model.copy) instead of one race at a time with the ORM.
+        """
+        import scraping
         time0 = time.time()
 
         # Only add race_ids not yet in table
         race_ids = sorted(list(set(race_ids) - set(cls.get_column('race_id'))))
 
         print('Scraping BikeReg race pages for metadata...')
-        futures = scraping.get_futures(race_ids)
-        for race_id, future in zip(race_ids, futures):
-            row = scraping.scrape_race_page(race_id, future.result().text)
-            cls.add([row])
-            print('Elapsed time: ', time.time() - time0)
+        batch = []
+        num_rows = 0
+        for race_id, text in scraping.get_race_pages(race_ids):
+            if text is None:  # failed - will be retried next time
+                continue
+            row = scraping.scrape_race_page(race_id, text)
+            if not bulk:
+                num_rows += cls.add([row])
+                print('Elapsed time: ', time.time() - time0)
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                num_rows += cls.copy(batch)
+                batch = []
+                print('Elapsed time: ', time.time() - time0)
+                metrics.set('ingest_rows_per_second',
+                            num_rows / (time.time() - time0), table='Races')
+        if batch:
+            num_rows += cls.copy(batch)
+        metrics.set('ingest_rows_per_second',
+                    num_rows / (time.time() - time0), table='Races')
+        cls.save_count()
+        db.session.commit()
+        race_cache.clear()
 
     @classmethod
     def get_categories(cls, race_id):
         """Return a list of RaceCategoryNames for the given race_id"""
-        return cls.query \
-                  .filter(cls.race_id == race_id) \
-                  .with_entities(cls.categories) \
-                  .first()[0]  # one row, one entity
+        return cls.get_race(race_id)['categories']
+
+    @classmethod
+    def get_race(cls, race_id):
+        """Get a dictionary of all columns for the race with given race_id,
+        loaded with one query and cached (see RaceCache). Returns None for
+        invalid race_id.
+        """
+        race = race_cache.get(race_id)
+        if race is None:
+            race = race_cache.add(cls.query
+                                     .filter(cls.race_id == race_id)
+                                     .with_entities(*cls.__table__.columns)
+                                     .first())
+        return race
 
     @classmethod
     def get_race_date(cls, race_id):
         """Get the date of the race with given race_id"""
-        date, = cls.query.filter(cls.race_id == race_id) \
-                        .with_entities(cls.date).first()
-        return date
+        return cls.get_race(race_id)['date']
 
     @classmethod
     def get_race_id(cls, name_date):
         """Get the race id for the race with the given name_date
-           (i.e., a key in the Races._race_names dictionary).
+           (e.g. 'Tour of Somerville (2019-05-27)').
            Returns None for invalid name_date."""
-        name, date = re.search(r'(.*) \((.*)\)', name_date).groups()
-        return (cls.query
-                   .filter(cls.name == name,
-                           cls.date == datetime.strptime(date, '%Y-%m-%d'))
-                   .with_entities(cls.race_id)
-                   .first()[0])
+        race_id = race_cache.get_id(name_date)
+        if race_id is not None:
+            return race_id
+
+        namedate = re.search(r'(.*) \((.*)\)', name_date)
+        if not namedate:
+            return None
+        name, date = namedate.groups()
+        try:
+            date = datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            return None
+        race = race_cache.add(cls.query
+                                 .filter(cls.name == name, cls.date == date)
+                                 .with_entities(*cls.__table__.columns)
+                                 .first())
+        return race['race_id'] if race else None
 
     @classmethod
     def get_race_name(cls, race_id):
         """Get the name of the race with given race_id"""
-        name, = cls.query.filter(cls.race_id == race_id) \
-                        .with_entities(cls.name).first()
-        return name
+        return cls.get_race(race_id)['name']
 
     @classmethod
     def get_race_name_date(cls, race_id):
         """Get the name and date of the race with given race_id"""
-        return '{} ({})'.format(cls.get_race_name(race_id),
-                                cls.get_race_date(race_id).strftime('%Y-%m-%d'))
-
-
-
+        return name_date(cls.get_race(race_id))
 
     @classmethod
     def get_random_id(cls):
@@ -206,10 +467,7 @@ class Races(Model, db.Model):
             name, date = namedate.groups()
         else:
             raise ValidationError('Regex failed!')
-        if not (cls.query
-                   .filter(cls.name == name,
-                           cls.date == datetime.strptime(date, '%Y-%m-%d'))
-                   .all()):
+        if cls.get_race_id(data) is None:
             msg = f'Can\'t find a race by the name {name}!\n'
             raise ValidationError(msg)
 
@@ -224,28 +482,40 @@ class Racers(Model, db.Model):
     sigma = db.Column(db.Float, default=config.SIGMA)
     num_races = db.Column(db.Integer, default=1)
 
+    # Racer lookups by name (get_racer_id, validator)
+    __table_args__ = (db.Index('ix_racers_name', 'Name'),)
+
     def __repr__(self):
         return f"Racer: {self.RacerID, self.Name, self.mu, self.sigma}"
 
     @classmethod
     def add_table(cls):
-        """Add racers to the table from the Results table."""
+        """Add racers to the table from the Results table. Only racers not
+        yet in the table are added.
+        """
         # For each RacerID, take "max" (only) name, max age, and min category.
         rows = (Results.query
                        .with_entities(Results.RacerID,
                                       func.max(Results.Name),
                                       func.max(Results.Age),
                                       func.min(Results.Category))
+                       .filter(~sa.exists().where(
+                           cls.RacerID == Results.RacerID))  # anti-join
                        .group_by(Results.RacerID))
         rows = ({'RacerID': row[0], 'Name': row[1],
                  'Age': row[2], 'Category': row[3]} for row in rows)
         cls.add(rows)
+        cls.save_count()
+        db.session.commit()
 
     @classmethod
     def get_avg_rating(cls):
         """Get the average skill rating for racers that have been rated at
         least once (i.e. they don't have the default rating of exactly 25).
         """
+        stats = RatingStats.load()
+        if stats:
+            return stats.mean if stats.count else config.MU
         racers = cls.query.filter(cls.mu != 25).all()
         mus = [racer.mu for racer in racers]
         return sum(mus) / len(mus)
@@ -304,15 +574,28 @@ class Results(Model, db.Model):
     predicted_place = db.Column(db.Integer)
     rated = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        # Results of a race category, in place order (get_race_table,
+        # get_random_racer_id, get_all_ratings)
+        db.Index('ix_results_race_category_place',
+                 'race_id', 'RaceCategoryName', 'Place'),
+        # Results of a racer (get_racer_results)
+        db.Index('ix_results_racer', 'RacerID'),
+    )
+
     def __repr__(self):
         return f"Result: {self.index, self.race_id, self.RaceCategoryName, self.Name, self.Place}"
 
 
     @classmethod
-    def add_table(cls, urls):
+    def add_table(cls, urls, bulk=True, batch_size=50000):
         """Add results from a list of BikeReg JSON file URLs. These can be
-        obtained from the Races table using Races.get_urls().
+        obtained from the Races table using Races.get_urls(). If bulk, rows
+        are added in batches of about batch_size rows with COPY (see
+        Model.copy) instead of one race at a time with the ORM.
         """
+        import scraping
+        from preprocess import clean_frame
 
         # Only add results with race_ids not yet in table
         d = {int(re.search('(\d+)', url).group()): url for url in urls}
@@ -323,17 +606,42 @@ class Results(Model, db.Model):
 
         time0 = time.time()
         print('Scraping BikeReg JSON results files...')
-        futures = scraping.get_results_futures(urls)
-        for race_id, url, future in zip(race_ids, urls, futures):
+        batch = []
+        num_rows = 0
+        added = []  # race_ids with results, for RacerHistory
+        for race_id, text in scraping.get_results_pages(race_ids, urls):
             print(race_id)
-            rows = scraping.scrape_results_json(race_id, future.result().text)
-            cls.add(rows)
-            print('Elapsed time: ', time.time() - time0)
+            if text is None:  # failed - will be retried next time
+                continue
+            added.append(race_id)
+            if not bulk:
+                num_rows += cls.add(scraping.scrape_results_json(race_id, text))
+                print('Elapsed time: ', time.time() - time0)
+                continue
+            # Clean many races at once
+            batch.extend(scraping.parse_results_json(race_id, text))
+            if len(batch) >= batch_size:
+                num_rows += cls.copy(clean_frame(batch))
+                batch = []
+                print('Elapsed time: ', time.time() - time0)
+                metrics.set('ingest_rows_per_second',
+                            num_rows / (time.time() - time0), table='Results')
+        if batch:
+            num_rows += cls.copy(clean_frame(batch))
+        metrics.set('ingest_rows_per_second',
+                    num_rows / (time.time() - time0), table='Results')
 
         print('Populating categories...')
         add_categories()
         print('Elapsed time: ', time.time() - time0)
 
+        print('Populating racer histories...')
+        RacerHistory.add_table(added)
+        print('Elapsed time: ', time.time() - time0)
+
+        cls.save_count()
+        db.session.commit()
+
     @classmethod
     def get_race_table(cls, race_id, RaceCategoryName):
         """For given race_id and RaceCategoryName, returns a generator of
@@ -356,6 +664,214 @@ class Results(Model, db.Model):
                                 cls.RaceCategoryName == category) \
                   .order_by(func.random()).first().RacerID
 
+class RacerHistory(Model, db.Model):
+    """Denormalized copy of each racer's results joined with race metadata,
+    clustered by RacerID and date, so that a racer's history is one index
+    range scan. Rows are added by Results.add_table and ratings are kept up
+    to date by the rating pass. The table is clustered by the
+    build_racer_history command.
+    """
+    ResultID = db.Column(db.Integer, primary_key=True)
+    index = synonym('ResultID')
+    RacerID = db.Column(db.Integer)
+    date = db.Column(db.DateTime)
+    race_id = db.Column(db.Integer)
+    RaceName = db.Column(db.String)
+    RaceCategoryName = db.Column(db.String)
+    Place = db.Column(db.Integer)
+    num_racers = db.Column(db.Integer)
+    prior_mu = db.Column(db.Float, default=config.MU)
+    prior_sigma = db.Column(db.Float, default=config.SIGMA)
+    mu = db.Column(db.Float, default=config.MU)
+    sigma = db.Column(db.Float,  default=config.SIGMA)
+    predicted_place = db.Column(db.Integer)
+
+    __table_args__ = (db.Index('ix_racer_history_racer_date',
+                               'RacerID', 'date'),)
+
+    def __repr__(self):
+        return f"RacerHistory: {self.index, self.RacerID, self.date, self.RaceName}"
+
+    @classmethod
+    def add_table(cls, race_ids=None, cluster=False):
+        """Add rows for results not yet in the table, only from the races
+        with the given race_ids if given (e.g. the races just added by
+        Results.add_table), so that an ingest does not scan all results. If
+        cluster, physically reorder the table by RacerID and date
+        afterwards, which locks and rewrites the whole table, so it is not
+        done on every ingest.
+        """
+        def in_races(query):
+            if race_ids is None:
+                return query
+            return query.filter(Results.race_id.in_(list(race_ids)))
+
+        num_racers = (in_races(db.session
+                                 .query(Results.race_id,
+                                        Results.RaceCategoryName,
+                                        func.count().label('num_racers')))
+                        .group_by(Results.race_id, Results.RaceCategoryName)
+                        .subquery('num_racers'))
+        rows = (db.session
+                  .query(Results.ResultID, Results.RacerID, Races.date,
+                         Results.race_id, Results.RaceName,
+                         Results.RaceCategoryName, Results.Place,
+                         num_racers.c.num_racers, Results.prior_mu,
+                         Results.prior_sigma, Results.mu, Results.sigma,
+                         Results.predicted_place)
+                  .join(Races, Races.race_id == Results.race_id)
+                  .join(num_racers,
+                        sa.and_(num_racers.c.race_id == Results.race_id,
+                                num_racers.c.RaceCategoryName
+                                == Results.RaceCategoryName))
+                  .filter(~sa.exists().where(
+                      cls.ResultID == Results.ResultID)))  # anti-join
+        rows = in_races(rows)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['ResultID', 'RacerID', 'date', 'race_id', 'RaceName',
+             'RaceCategoryName', 'Place', 'num_racers', 'prior_mu',
+             'prior_sigma', 'mu', 'sigma', 'predicted_place'],
+            rows.statement))
+        if cluster:
+            db.session.execute(f'CLUSTER "{cls.__table__.name}" '
+                               'USING ix_racer_history_racer_date')
+        db.session.commit()
+
+    @classmethod
+    def get_racer_history(cls, racer_id):
+        """For a given RacerID, returns rows for that racer ordered by
+        date."""
+        return cls.query.filter(cls.RacerID == racer_id).order_by(cls.date)
+
+
+class Checkpoints(Model, db.Model):
+    name = db.Column(db.String, primary_key=True)
+    index = synonym('name')
+    date = db.Column(db.DateTime)
+    race_id = db.Column(db.Integer)
+    RaceCategoryName = db.Column(db.String)
+
+    def __repr__(self):
+        return f"Checkpoint: {self.name, self.date, self.race_id, self.RaceCategoryName}"
+
+    @classmethod
+    def clear(cls, name):
+        """Delete the checkpoint with the given name, if any."""
+        cls.query.filter(cls.name == name).delete()
+
+    @classmethod
+    def load(cls, name):
+        """Get the checkpoint with the given name. Returns None if there is
+        no such checkpoint.
+        """
+        return cls.query.filter(cls.name == name).first()
+
+    @classmethod
+    def save(cls, name, **values):
+        """Create or update the checkpoint with the given name. Does not
+        commit, so that the checkpoint is committed along with the work it
+        records.
+        """
+        checkpoint = cls.load(name)
+        if checkpoint:
+            for col, value in values.items():
+                setattr(checkpoint, col, value)
+        else:
+            db.session.add(cls(name=name, **values))
+
+
+class Counters(Model, db.Model):
+    """Named integers shared by all workers, e.g. 'ratings_version', which
+    changes whenever ratings change, 'Results_rows', the number of rows
+    in the Results table when data was last added, and 'database_token', a
+    random number identifying the database."""
+    name = db.Column(db.String, primary_key=True)
+    index = synonym('name')
+    value = db.Column(db.BigInteger, default=0)
+
+    def __repr__(self):
+        return f"Counter: {self.name, self.value}"
+
+    @classmethod
+    def get(cls, name, default=0):
+        """Get the value of the named counter."""
+        row = (cls.query.filter(cls.name == name)
+                        .with_entities(cls.value)
+                        .first())
+        return row[0] if row else default
+
+    @classmethod
+    def set(cls, name, value):
+        """Set the named counter. Does not commit."""
+        if not cls.query.filter(cls.name == name).update(
+                {cls.value: value}, synchronize_session=False):
+            db.session.add(cls(name=name, value=value))
+
+    @classmethod
+    def get_cache_version(cls):
+        """A string identifying the current ratings for caches (e.g.
+        '8312...:42'): the ratings version, prefixed by a token created
+        with the table (see commands.db_create_all), since the version
+        restarts when the tables are dropped and created again."""
+        values = dict(cls.query
+                         .filter(cls.name.in_(['database_token',
+                                               'ratings_version']))
+                         .with_entities(cls.name, cls.value))
+        return (f"{values.get('database_token', 0)}:"
+                f"{values.get('ratings_version', 0)}")
+
+    @classmethod
+    def increment(cls, name):
+        """Add one to the named counter. Does not commit."""
+        if not cls.query.filter(cls.name == name).update(
+                {cls.value: cls.value + 1}, synchronize_session=False):
+            db.session.add(cls(name=name, value=1))
+
+
+class RatingStats(Model, db.Model):
+    """Aggregates of the mu ratings of rated racers (those without the
+    default rating), for all racers (scope 'all') and for each racer
+    category (e.g. scope 'Category 3'). Kept up to date by the rating pass
+    so that the website never has to read every Racers row.
+    """
+    scope = db.Column(db.String, primary_key=True)
+    index = synonym('scope')
+    count = db.Column(db.Integer)
+    total = db.Column(db.Float)  # sum of mu
+    total_sq = db.Column(db.Float)  # sum of mu ** 2
+    histogram = db.Column(db.ARRAY(db.Integer))  # counts in BIN_EDGES bins
+
+    BIN_EDGES = list(range(0, 51))  # ratings outside are in the end bins
+
+    def __repr__(self):
+        return f"RatingStats: {self.scope, self.count, self.mean}"
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def variance(self):
+        if not self.count:
+            return None
+        return self.total_sq / self.count - self.mean ** 2
+
+    @classmethod
+    def load(cls, scope='all'):
+        """Get the aggregates for the given scope. Returns None if they have
+        not been computed yet.
+        """
+        return cls.query.filter(cls.scope == scope).first()
+
+    @classmethod
+    def replace(cls, rows):
+        """Replace all aggregates with the given rows (dictionaries). Does
+        not commit.
+        """
+        cls.query.delete()
+        db.session.add_all([cls(**row) for row in rows])
+
+
 def add_categories():
     """Update the Races table with the categories represented in the
     Results table.
@@ -377,6 +893,7 @@ def add_categories():
                           func.array_agg(cat_counts.c.count).label('num_racers'))
                    .group_by(cat_counts.c.race_id))
     Races.update([c._asdict() for c in collected])
+    race_cache.clear()
 
 
 def filter_races():
@@ -390,30 +907,81 @@ def filter_races():
 
 
 
+def export_table(Table, format='csv', after=None, batch_size=10000):
+    """Yield the rows of Table as text in CSV (with a header) or NDJSON
+    format, one chunk per batch (see Model.iter_batches), for streaming
+    large tables. Arrays are written as JSON, dates in ISO format and NaN
+    or infinite floats as missing values (null).
+    """
+    cols = Table.get_columns()
+
+    def convert(value):
+        if isinstance(value, float) and not math.isfinite(value):
+            return None  # NaN is not valid JSON
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, list) and format == 'csv':
+            return json.dumps(value)
+        return value
+
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(cols)
+        yield buffer.getvalue()
+
+    for rows in Table.iter_batches(batch_size=batch_size, after=after):
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([convert(value) for value in row]
+                             for row in rows)
+            yield buffer.getvalue()
+        else:
+            yield ''.join(json.dumps(dict(zip(cols, map(convert, row))),
+                                     allow_nan=False) + '\n'
+                          for row in rows)
+
+
+def get_table_counts(tables=(Races, Results, Racers)):
+    """Returns a dictionary of the number of rows in each of the given
+    tables by name (e.g. 'Results') without counting them: counts saved
+    when data was added (see Model.save_count) or, failing that,
+    PostgreSQL's estimate from its table statistics.
+    """
+    saved = dict(Counters.query
+                         .filter(Counters.name.in_([f'{Table.__name__}_rows'
+                                                    for Table in tables]))
+                         .with_entities(Counters.name, Counters.value))
+    counts = {}
+    for Table in tables:
+        count = saved.get(f'{Table.__name__}_rows')
+        if count is None:
+            count = db.session.execute(
+                sa.text('SELECT reltuples::bigint FROM pg_class '
+                        'WHERE relname = :name'),
+                {'name': Table.__table__.name}).scalar()
+        counts[Table.__name__] = max(count or 0, 0)  # -1 if never analyzed
+    return counts
+
+
+def get_race_rows(race_id, RaceCategoryName):
+    """Returns a list of dictionaries of the Results rows for the given
+    race_id and RaceCategoryName, which (unlike row objects) can be cached
+    independently of the database session.
+    """
+    cols = Results.get_columns()
+    return [{col: getattr(row, col) for col in cols}
+            for row in Results.get_race_table(race_id, RaceCategoryName)]
+
+
 def get_racer_table(racer_id):
-    """Returns a list of dictionaries of results for the given racer id.
-    Each dictionary is essentially a Results row object with some
-    information joined from the Races table: date and num_racers,
-    where num_racers is the appropriate number of racers for the
-    RaceCategoryName associated with the result.
+    """Returns a list of dictionaries of results for the given racer id,
+    ordered by date. Each dictionary is a RacerHistory row: essentially a
+    Results row with some information joined from the Races table: date
+    and num_racers, where num_racers is the appropriate number of racers
+    for the RaceCategoryName associated with the result.
     """
-    racer_results = Results.get_racer_results(racer_id)
-    race_metadata = racer_results.join(Races, Races.race_id == Results.race_id) \
-                                 .with_entities(Results,
-                                                Races.date,
-                                                Races.categories,
-                                                Races.num_racers) \
-                                 .order_by(Races.date)
-
-    def get_num_racers(category, categories, num_racers):
-        return num_racers[categories.index(category)]
-
-    dict_merge = lambda a,b: a.update(b) or a  # updates a with b then returns a
-
-    racer_table = []
-    for row, date, categories, num_racers in race_metadata:
-        meta = {'date': date,
-                'num_racers': get_num_racers(row.RaceCategoryName,
-                                             categories, num_racers)}
-        racer_table.append(dict_merge(row.__dict__, meta))
-    return racer_table
+    cols = RacerHistory.get_columns()
+    return [{col: getattr(row, col) for col in cols}
+            for row in RacerHistory.get_racer_history(racer_id)]
@@ -1,39 +1,75 @@
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import altair as alt
-import seaborn as sns
-
-sns.set()
-
-import evaluation
-
-def make_corr_plot():
+import json
+from functools import lru_cache
+
+# matplotlib, seaborn, altair and pandas take seconds to import, so they are
+# imported on first use instead of when each worker starts.
+
+EVALUATION_PATH = 'static/plots/evaluation.json'
+
+@lru_cache(maxsize=None)
+def pyplot():
+    """matplotlib.pyplot with the seaborn style, imported on first use."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set()
+    return plt
+
+def make_evaluation_plots(version):
+    """Makes the plots for the evaluation page and returns the evaluation
+    metrics. The plots and metrics are saved along with the ratings version
+    they were made from, and are only remade when the ratings change.
+    """
+    try:
+        with open(EVALUATION_PATH) as f:
+            saved = json.load(f)
+        if saved['version'] == version:
+            return saved['metrics']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import evaluation
+    corr, metrics = evaluation.get_metrics()
+    make_hist()
+    make_corr_plot(corr)
+    with open(EVALUATION_PATH, 'w') as f:
+        json.dump({'version': version, 'metrics': metrics}, f)
+    return metrics
+
+def make_corr_plot(corr=None):
     """Makes a histogram of the Spearman correlation for each race."""
-    corr = evaluation.correlation()
+    import evaluation
+    if corr is None:
+        corr = evaluation.correlation()
+    plt = pyplot()
     fig, ax = plt.subplots()
     ax.hist(corr, bins=30)
     ax.set_xlim(-1, 1)
     ax.set_xlabel('Spearman correlation')
     ax.set_ylabel('Counts')
     fig.savefig('static/plots/correlation.png')
+    plt.close(fig)
 
 def make_hist():
     """Makes a histogram of all mean skill rating values."""
-    mus = evaluation.get_mean_ratings()
+    import evaluation
+    edges, counts = evaluation.get_rating_histogram()
+    plt = pyplot()
     fig, ax = plt.subplots()
-    ax.hist(mus, bins=30)
+    ax.hist(edges[:-1], bins=edges, weights=counts)
     ax.set_xlim(0, 45)
     ax.set_xlabel('Skill rating')
     ax.set_ylabel('Counts')
     fig.savefig('static/plots/ratings.png')
+    plt.close(fig)
 
 def make_racer_plot(racer_table, avg=25):
     """Plot each racer's rating over time using altair. Avg = average rating
     to plot as a dashed line.
     """
+    import altair as alt
+    import pandas as pd
 
-    df = pd.DataFrame.from_records(racer_table, exclude=['_sa_instance_state'])
+    df = pd.DataFrame.from_records(racer_table)
     df['date'] = df['date'].dt.strftime('%B %d, %Y')  #.strftime('%m/%d/%y')
 
     dnf = df['Place'].isna()
@@ -0,0 +1,140 @@
+import numpy as np
+
+from model import Racers
+from ratings import env
+
+# Points at which each racer's performance distribution is evaluated when
+# integrating for place probabilities
+GRID_SIZE = 256
+
+# Limits on a prediction request, which take memory proportional to
+# racers * places * GRID_SIZE
+MAX_TOP_K = 20
+MAX_RACERS = 500  # per start list
+MAX_START_LISTS = 1000
+
+
+def get_performance_sd(sigmas, env=env):
+    """Standard deviation of each racer's performance in the next race: the
+    rating uncertainty (plus the dynamics tau added before each race) and
+    the race-to-race variation beta."""
+    return np.sqrt(np.asarray(sigmas) ** 2 + env.tau ** 2 + env.beta ** 2)
+
+
+def get_win_matrix(mus, sigmas, env=env):
+    """Returns an n x n array of the probability that racer i finishes ahead
+    of racer j, for racers with the given mus and sigmas (0.5 on the
+    diagonal)."""
+    from scipy.special import ndtr  # slow to import; only needed here
+    mus = np.asarray(mus, dtype=np.float64)
+    var = get_performance_sd(sigmas, env) ** 2
+    return ndtr((mus[:, None] - mus[None, :])
+                / np.sqrt(var[:, None] + var[None, :]))
+
+
+def get_place_probabilities(mus, sigmas, max_place, env=env,
+                            grid_size=GRID_SIZE):
+    """Returns an n x max_place array of the probability that each racer
+    finishes in each of the first max_place places.
+
+    A racer with performance x finishes in place c + 1 if exactly c of the
+    others perform better than x. For every x on a grid, the distribution
+    of that count (up to max_place - 1) is built for the racers before and
+    after each racer, so that all racers are done at once, and then
+    integrated over each racer's performance distribution.
+    """
+    from scipy.special import ndtr
+    mus = np.asarray(mus, dtype=np.float64)
+    sds = get_performance_sd(sigmas, env)
+    n = len(mus)
+    max_place = min(max_place, n)
+
+    x = np.linspace((mus - 6 * sds).min(), (mus + 6 * sds).max(), grid_size)
+    better = ndtr((mus[:, None] - x[None, :]) / sds[:, None])  # P(perf > x)
+    weights = np.exp(-0.5 * ((x[None, :] - mus[:, None]) / sds[:, None]) ** 2)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    def add_racer(counts, p):
+        """Distribution of the count with one more racer who is better with
+        probability p, dropping counts of max_place or more."""
+        new = counts * (1 - p)
+        new[1:] += counts[:-1] * p
+        return new
+
+    # before[i] / after[i]: distribution of the number of racers before /
+    # after racer i that perform better than x, for each x
+    before = np.zeros((n, max_place, grid_size))
+    after = np.zeros((n, max_place, grid_size))
+    before[0, 0] = after[-1, 0] = 1
+    for i in range(1, n):
+        before[i] = add_racer(before[i - 1], better[i - 1])
+        after[n - 1 - i] = add_racer(after[n - i], better[n - i])
+
+    probabilities = np.zeros((n, max_place))
+    for c in range(max_place):
+        others = sum(before[:, a] * after[:, c - a] for a in range(c + 1))
+        probabilities[:, c] = (weights * others).sum(axis=1)
+    return probabilities
+
+
+def predict(mus, sigmas, top_k=(3,), env=env):
+    """Predicts the outcome of a race between one or more racers with the
+    given mus and sigmas. Returns a dictionary of arrays in the order of the
+    racers: the expected place, the win matrix (see get_win_matrix), and the
+    probabilities of winning and of finishing in the top k for each k in
+    top_k.
+    """
+    win_matrix = get_win_matrix(mus, sigmas, env)
+    # Expected place = 1 + expected number of others finishing ahead
+    expected_place = win_matrix.sum(axis=0) + 0.5
+    places = get_place_probabilities(mus, sigmas, max(top_k, default=1),
+                                     env).cumsum(axis=1)
+    return {'expected_place': expected_place,
+            'win_matrix': win_matrix,
+            'win_probability': places[:, 0],
+            **{f'top_{k}_probability': places[:, min(k, len(mus)) - 1]
+               for k in top_k}}
+
+
+def predict_races(start_lists, top_k=(3,)):
+    """Predicts the outcomes of races from the current ratings of the racers
+    in each start list (a list of RacerIDs), e.g. for a whole calendar of
+    upcoming races. Racers not in the Racers table get the default rating.
+
+    Returns a list of dictionaries, one per start list, of 'order' (the
+    RacerIDs in expected finishing order), 'racers' (a dictionary for each
+    racer, in that order, with their rating, expected place and win and
+    top-k probabilities) and 'win_matrix', where win_matrix[i][j] is the
+    probability that the ith racer finishes ahead of the jth.
+    """
+    racer_ids = {racer_id for start_list in start_lists
+                 for racer_id in start_list}
+    ratings = {row.RacerID: row for row in
+               Racers.query.filter(Racers.RacerID.in_(racer_ids))
+                           .with_entities(Racers.RacerID, Racers.Name,
+                                          Racers.mu, Racers.sigma)}
+
+    races = []
+    for start_list in start_lists:
+        if not start_list:
+            races.append({'order': [], 'racers': [], 'win_matrix': []})
+            continue
+        rows = [ratings.get(racer_id) for racer_id in start_list]
+        mus = np.array([env.mu if row is None else row.mu for row in rows])
+        sigmas = np.array([env.sigma if row is None else row.sigma
+                           for row in rows])
+        prediction = predict(mus, sigmas, top_k)
+        order = np.argsort(prediction['expected_place'], kind='stable')
+        racers = [{'RacerID': start_list[i],
+                   'Name': None if rows[i] is None else rows[i].Name,
+                   'mu': float(mus[i]),
+                   'sigma': float(sigmas[i]),
+                   **{name: float(values[i])
+                      for name, values in prediction.items()
+                      if name != 'win_matrix'}}
+                  for i in order]
+        races.append({'order': [start_list[i] for i in order],
+                      'racers': racers,
+                      'win_matrix': prediction['win_matrix'][
+                                        np.ix_(order, order)].tolist()})
+    return races
@@ -1,5 +1,11 @@
 import re
 import numpy as np
+import pandas as pd
+
+# Missing names - there may be more!
+BAD_RACER_IDS = {3288, 61706, 832, 351}
+
+digit_regex = re.compile(r'[\d]')
 
 def clean(rows):
     """Cleans JSON file for each race. rows is a list of dictionaries.
@@ -8,6 +14,40 @@ def clean(rows):
     rows = map(process_rider, rows)
     return rows
 
+def clean_frame(rows):
+    """Cleans the JSON rows for many races at once. rows is a list of
+    dictionaries. Does the same processing as clean, but on columns of a
+    DataFrame, and returns a DataFrame with only the valid rows.
+    """
+    df = pd.DataFrame.from_records(rows)
+    if df.empty:
+        return df
+
+    def column(col, default=None):
+        return df[col] if col in df else pd.Series(default, index=df.index)
+
+    # Remove places for DNF/DNP/DQ (see handle_missing)
+    missing = (column('IsDnf').eq(1) | column('IsDNP').eq(1)
+               | column('IsDQ').eq(1))
+    df['Place'] = column('Place').astype(float).mask(missing).astype('Int64')
+
+    # Drop racers with missing names or names containing digits (see
+    # process_rider)
+    first = column('FirstName').fillna('').astype(str)
+    last = column('LastName').fillna('').astype(str)
+    valid = (~column('RacerID').isin(BAD_RACER_IDS)
+             & (first != '')
+             & (first != 'Unknown')
+             & ~first.str.contains(digit_regex)
+             & ~last.str.contains(digit_regex))
+    df = df[valid].copy()
+
+    # Combine names and ages
+    df['Name'] = first[valid] + ' ' + last[valid]
+    df['Age'] = np.maximum(column('CalculatedAge')[valid].fillna(0),
+                           column('ReportedAge')[valid].fillna(0))
+    return df
+
 def handle_missing(row):
     """Removes the Place column from a row if result was a DNF/DNP/DQ.
     """
@@ -22,12 +62,11 @@ def process_rider(row):
         the name contains digits
     - Consolidates age columns
     """
-    # Missing names - there may be more!
-    if (row['RacerID'] in [3288, 61706, 832, 351]) \
+    if (row['RacerID'] in BAD_RACER_IDS) \
         or (not row['FirstName']) \
         or (row['FirstName'] == 'Unknown') \
-        or (re.search(r'[\d]', row['FirstName'])) \
-        or (re.search(r'[\d]', row['LastName'])):
+        or (digit_regex.search(row['FirstName'])) \
+        or (digit_regex.search(row['LastName'])):
         return {}
 
     # Combine names
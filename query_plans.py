@@ -0,0 +1,99 @@
+import json
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+
+from database import db
+from model import Races, Results, Racers, RacerHistory
+import ratings
+
+# Example checkpoint for resuming a rating run (see ratings.get_all_ratings)
+CHECKPOINT = SimpleNamespace(date='2019-05-27', race_id=5291,
+                             RaceCategoryName='Men Cat 3')
+
+# The queries behind the website and the rating pass, with example
+# parameters, and the index each must use
+HOT_QUERIES = {
+    'Results.get_race_table':
+        (lambda: Results.get_race_table(5291, 'Men Cat 3'),
+         'ix_results_race_category_place'),
+    'Results.get_racer_results':
+        (lambda: Results.get_racer_results(12150), 'ix_results_racer'),
+    'Results.get_random_racer_id':
+        (lambda: Results.query.filter(Results.race_id == 5291,
+                                      Results.RaceCategoryName == 'Men Cat 3'),
+         'ix_results_race_category_place'),
+    'Races.get_race_id':
+        (lambda: Races.query.filter(Races.name == 'Tour of Somerville',
+                                    Races.date == '2019-05-27'),
+         'ix_races_name_date'),
+    'Racers.get_racer_id':
+        (lambda: Racers.query.filter(Racers.Name == 'Jane Doe'),
+         'ix_racers_name'),
+    'RacerHistory.get_racer_history':
+        (lambda: RacerHistory.get_racer_history(12150),
+         'ix_racer_history_racer_date'),
+    'ratings.get_ordered_results':
+        (lambda: ratings.get_ordered_results(after=CHECKPOINT),
+         'ix_races_date_race_id'),
+}
+
+
+def explain(query):
+    """Returns the PostgreSQL plan (as a dictionary) for a SQLAlchemy
+    query."""
+    compiled = query.statement.compile(dialect=postgresql.dialect())
+    plan, = db.session.connection().execute(
+        f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).fetchone()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def get_seq_scans(plan):
+    """Names of the tables read with a sequential scan anywhere in plan."""
+    return [node['Relation Name'] for node in get_nodes(plan)
+            if node['Node Type'] == 'Seq Scan']
+
+
+def get_nodes(plan):
+    """All nodes of plan, depth first."""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from get_nodes(child)
+
+
+def check_query_plans(queries=HOT_QUERIES):
+    """Runs EXPLAIN on each hot query and returns the names of the queries
+    whose plan does not use their expected index, or reads a table with a
+    sequential scan.
+
+    Sequential scans are disabled for the check (enable_seqscan = off), so
+    that the planner uses an index wherever one can serve the query, even
+    on a small database where scanning the whole table would be cheaper.
+    Even so, the planner can fall back to scanning a whole index, e.g. the
+    primary key for a query ordered by it, so each query is checked for the
+    index that should serve it.
+    """
+    failures = []
+    db.session.execute('SET LOCAL enable_seqscan = off')
+    try:
+        for name, (query, index) in queries.items():
+            plan = explain(query())
+            problems = []
+            indexes = [node['Index Name'] for node in get_nodes(plan)
+                       if 'Index Name' in node]
+            if index not in indexes:
+                problems.append(f'does not use {index}')
+            seq_scans = get_seq_scans(plan)
+            if seq_scans:
+                problems.append(f'sequential scan on {", ".join(seq_scans)}')
+            status = f'FAIL ({"; ".join(problems)})' if problems else 'ok'
+            print(f'{name}: {status} [{plan["Node Type"]} using '
+                  f'{", ".join(indexes) or "no index"}, '
+                  f'cost {plan["Total Cost"]}]')
+            if problems:
+                failures.append(name)
+    finally:
+        db.session.rollback()
+    return failures
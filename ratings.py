@@ -1,105 +1,415 @@
+import multiprocessing
 import time
+from types import SimpleNamespace
 
+import numpy as np
 import trueskill as ts
 
 from itertools import groupby
-from sqlalchemy import update
-from scipy.stats import rankdata
+from sqlalchemy import update, func, and_, exists, tuple_
+from sqlalchemy.orm import aliased
 
 import config
+import fastskill
 from database import db
-from model import Races, Results, Racers
+from metrics import metrics
+from model import (Races, Results, Racers, Checkpoints, RatingStats,
+                   Counters, RacerHistory)
 
 env = ts.TrueSkill(mu=config.MU, sigma=config.SIGMA,
                    backend='mpmath', draw_probability=0)
 
-def get_all_ratings(debug_limit=None):
-    """Get all ratings for results in the Results table."""
+def get_all_ratings(debug_limit=None, only_new=False, resume=False,
+                    chunk_size=500, processes=None):
+    """Get all ratings for results in the Results table. If only_new, only
+    rate race categories that have not been rated yet (see get_new_results),
+    starting from the current ratings in the Racers table.
+
+    Results are streamed from the database in rating order and committed
+    every chunk_size race categories along with a checkpoint of the last
+    rated category. If resume, start rating after the saved checkpoint
+    (e.g. after an interrupted run).
+
+    If processes > 1 (Default: config.RATING_PROCESSES), categories that
+    share no racers are rated in parallel (see rate_in_parallel). The
+    ratings are identical to rating one category at a time.
+    """
+    processes = processes or config.RATING_PROCESSES
 
     time0 = time.time()
 
     print('Starting to rate!')
-    ordered_results = (Results.query
-                              .join(Races, Races.race_id == Results.race_id)
-                              .order_by(Races.date,
-                                        Results.race_id,
-                                        Results.RaceCategoryName,
-                                        Results.Place))
-
-    groups = groupby(ordered_results.limit(debug_limit),
-                     lambda x: (x.race_id, x.RaceCategoryName))
-    print(f'Made groupby: {time.time() - time0}') # 8s for full dataset
-
-    # Warning... this will hog memory!
-    # Entire dataset took nearly 3 hours
-    for (race_id, category), results in groups:  # ~30s delay to fetch and start
-        print(f'Rating race {race_id} category {category}')
+    checkpoint = Checkpoints.load('ratings') if resume else None
+    if checkpoint:
+        print(f'Resuming after race {checkpoint.race_id} '
+              f'category {checkpoint.RaceCategoryName}')
+    ordered_results = get_ordered_results(only_new=only_new,
+                                          after=checkpoint).limit(debug_limit)
+
+    # Stream rows with a server-side cursor on a separate connection so that
+    # committing each chunk doesn't close the cursor
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        rows = (SimpleNamespace(**dict(row))
+                for row in connection.execute(ordered_results.statement))
+        groups = groupby(rows,
+                         lambda x: (x.date, x.race_id, x.RaceCategoryName))
+
+        # Current ratings for every racer, updated in memory as we go
+        store = RatingStore()
+        print(f'Loaded racer ratings: {time.time() - time0}')
+
+        if processes > 1:
+            rated_groups = rate_in_parallel(groups, store, processes)
+        else:
+            rated_groups = rate_serially(groups, store)
+
+        pending = []  # updated results not yet written to the database
+        num_categories = num_results = 0
+        for (date, race_id, category), results in rated_groups:
+            pending.extend(results)
+            num_categories += 1
+            num_results += len(results)
+            metrics.inc('rating_categories_total')
+            metrics.inc('rating_results_total', len(results))
+
+            if num_categories % chunk_size == 0:
+                commit_ratings(pending, store, date, race_id, category)
+                pending = []
+                set_throughput(num_categories, num_results, time0)
+                print(f'Elapsed time: {time.time() - time0}')
+    finally:
+        connection.close()
+
+    if num_categories:
+        commit_ratings(pending, store, date, race_id, category)
+    set_throughput(num_categories, num_results, time0)
+    print(f'Rated {num_categories} categories: {time.time() - time0}')
+
+
+def set_throughput(num_categories, num_results, time0):
+    """Update the rating throughput gauges for a run started at time0."""
+    elapsed = time.time() - time0
+    metrics.set('rating_categories_per_second', num_categories / elapsed)
+    metrics.set('rating_results_per_second', num_results / elapsed)
+
+
+def get_ordered_results(only_new=False, after=None):
+    """Query for the results to rate with their race dates, in rating
+    order: by race date, race, category and place. If only_new, only include
+    race categories that have not been rated yet (see get_new_results). If
+    after is a checkpoint (see Checkpoints), only include categories after
+    it.
+    """
+    ordered_results = (db.session
+                         .query(Results.ResultID,
+                                Results.RacerID,
+                                Results.race_id,
+                                Results.RaceCategoryName,
+                                Results.Place,
+                                Races.date)
+                         .join(Races, Races.race_id == Results.race_id))
+    if only_new:
+        ordered_results = get_new_results(ordered_results)
+    if after:
+        ordered_results = ordered_results.filter(
+            tuple_(Races.date, Results.race_id, Results.RaceCategoryName)
+            > tuple_(after.date, after.race_id, after.RaceCategoryName))
+    return ordered_results.order_by(Races.date,
+                                    Results.race_id,
+                                    Results.RaceCategoryName,
+                                    Results.Place)
+
+
+def rate_serially(groups, store):
+    """Rates each (key, results) group in order, updating the store. Yields
+    each key with its list of rated results.
+    """
+    for key, results in groups:
+        print(f'Rating race {key[1]} category {key[2]}')
         results = list(results)
+        placing_results = get_priors(results, store)
+        if len(placing_results) > 1:  # don't rate uncontested races
+            set_ratings(placing_results, run_trueskill(placing_results),
+                        store)
+        yield key, results
+
+
+def rate_in_parallel(groups, store, processes, max_wave=1000):
+    """Rates each (key, results) group like rate_serially, but dispatches
+    waves of consecutive groups that share no racers to a process pool.
+    No racer's rating changes within a wave, so every group sees the same
+    priors it would have seen in order and the ratings are identical.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        for wave in get_waves(groups, max_wave):
+            print(f'Rating {len(wave)} categories starting with '
+                  f'race {wave[0][0][1]} category {wave[0][0][2]}')
+            placing = [get_priors(results, store) for _, results in wave]
+            contested = [p for p in placing if len(p) > 1]
+            new_ratings = pool.map(rate_priors,
+                                   [[(result.prior_mu, result.prior_sigma)
+                                     for result in placing_results]
+                                    for placing_results in contested],
+                                   chunksize=max(1, len(contested)
+                                                    // (4 * processes)))
+            # Update the store only as each group is yielded, so that a
+            # commit partway through a wave (see get_all_ratings) writes no
+            # ratings for groups after its checkpoint
+            new_ratings = iter(new_ratings)
+            for (key, results), placing_results in zip(wave, placing):
+                if len(placing_results) > 1:
+                    set_ratings(placing_results, next(new_ratings), store)
+                yield key, results
 
-        # Get Racers rows corresponding to the results
-        racers = [Racers.query.get(result.RacerID) for result in results]
-        # print(f'Got racers rows: {time.time() - time0}')
-
-        # Store prior ratings in Results table in both prior mu/sigma and
-        # current mu/sigma columns - current mu/sigma will change for placing
-        # racers and not change for DNF racers
-        for result, racer in zip(results, racers):
-            result.prior_mu = racer.mu
-            result.prior_sigma = racer.sigma
-            result.mu = racer.mu
-            result.sigma = racer.sigma
-        # print(f'store prior ratings: {time.time() - time0}')
-
-        # Predicted placing for ALL racers (including DNFs)
-        get_predicted_places(results)
-        # print(f'Predicted places: {time.time() - time0}')
-
-        # Filter out DNFs - make lists from pairs of results/racers with
-        # valid result.Place
-        result_racer_tuples = list(filter(
-            lambda x: x[0].Place != None, zip(results, racers)
-        ))
-        if not result_racer_tuples:
-            continue  # empty list!
-        placing_results, placing_racers = map(list, zip(*result_racer_tuples))
-        # print(f'Filter DNFs: {time.time() - time0}')
-
-
-        # Rate using trueskill
-        if len(placing_results) <= 1:  # don't rate uncontested races
-            continue
-        new_ratings = run_trueskill(placing_results)
-        # print(f'Run trueskill: {time.time() - time0}')
-
-        # Update results and racers rows
-        for result, racer, rating in zip(placing_results,
-                                         placing_racers,
-                                         new_ratings):
-            result.mu = racer.mu = rating.mu
-            result.sigma = racer.sigma = rating.sigma
-            result.rated = True
-
-        print(f'Elapsed time: {time.time() - time0}')
-
-    # Committing took ~15 seconds when stopping entire dataset early, but
-    # was instant when done after rating the whole dataset
+
+def get_waves(groups, max_wave):
+    """Splits (key, results) groups into lists of consecutive groups where
+    no racer appears in more than one group of a list. Each list has at most
+    max_wave groups.
+    """
+    wave, racer_ids = [], set()
+    for key, results in groups:
+        results = list(results)
+        ids = {result.RacerID for result in results}
+        if wave and (ids & racer_ids or len(wave) >= max_wave):
+            yield wave
+            wave, racer_ids = [], set()
+        wave.append((key, results))
+        racer_ids |= ids
+    if wave:
+        yield wave
+
+
+def get_priors(results, store):
+    """Sets prior ratings and predicted places for the results for one
+    category of one race, given in finishing order, from the ratings in the
+    store. Returns the list of placing (non-DNF) results.
+    """
+    # Store prior ratings in both prior mu/sigma and current mu/sigma -
+    # current mu/sigma will change for placing racers and not change for DNF
+    # racers
+    mus, sigmas = store.get([result.RacerID for result in results])
+    for result, mu, sigma in zip(results, mus, sigmas):
+        result.prior_mu = result.mu = float(mu)
+        result.prior_sigma = result.sigma = float(sigma)
+        result.rated = False
+
+    # Predicted placing for ALL racers (including DNFs)
+    get_predicted_places(results)
+
+    # Filter out DNFs - results with valid result.Place
+    return [result for result in results if result.Place != None]
+
+
+def rate_priors(priors):
+    """Runs TrueSkill on a list of (prior_mu, prior_sigma) tuples in
+    finishing order and returns a list of (mu, sigma) tuples. Used by the
+    worker processes in rate_in_parallel.
+    """
+    results = [SimpleNamespace(prior_mu=mu, prior_sigma=sigma)
+               for mu, sigma in priors]
+    return [(float(rating.mu), float(rating.sigma))
+            for rating in run_trueskill(results)]
+
+
+def set_ratings(placing_results, new_ratings, store):
+    """Sets the new ratings for the placing results, as Rating objects or
+    (mu, sigma) tuples, and updates the store. Does nothing if the rating
+    failed (no new ratings).
+    """
+    if not new_ratings:  # rating failed
+        return
+    for result, rating in zip(placing_results, new_ratings):
+        result.mu, result.sigma = map(float, rating)
+        result.rated = True
+    store.set([result.RacerID for result in placing_results],
+              [result.mu for result in placing_results],
+              [result.sigma for result in placing_results])
+
+
+def commit_ratings(results, store, date, race_id, category):
+    """Writes rated results and changed racer ratings to the database and
+    commits them together with a checkpoint for the last rated category.
+    """
     time0 = time.time()
-    db.session.flush()
-    db.session.commit()
+    with metrics.timer('rating_commit_seconds'):
+        mappings = [{'ResultID': result.ResultID,
+                     'prior_mu': result.prior_mu,
+                     'prior_sigma': result.prior_sigma,
+                     'mu': result.mu,
+                     'sigma': result.sigma,
+                     'predicted_place': result.predicted_place,
+                     'rated': result.rated} for result in results]
+        Results.update(mappings, commit=False)
+        RacerHistory.update(mappings, commit=False)
+        store.write_back(commit=False)
+        RatingStats.replace(store.get_stats())
+        Counters.increment('ratings_version')
+        Checkpoints.save('ratings', date=date, race_id=race_id,
+                         RaceCategoryName=category)
+        db.session.flush()
+        db.session.commit()
     print(f'Committing took: {time.time() - time0}')
 
 
+class RatingStore:
+    """Current mu and sigma for every racer in the Racers table, kept in
+    arrays indexed by RacerID so that the rating loop never has to touch
+    Racers rows. Changed ratings are written back in bulk by write_back.
+    """
+
+    def __init__(self):
+        rows = Racers.query.with_entities(Racers.RacerID,
+                                          Racers.mu,
+                                          Racers.sigma,
+                                          Racers.Category).all()
+        racer_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        size = racer_ids.max() + 1 if len(racer_ids) else 0
+
+        self.mu = np.full(size, env.mu, dtype=np.float64)
+        self.sigma = np.full(size, env.sigma, dtype=np.float64)
+        self.category = np.full(size, -1, dtype=np.int64)  # -1 for unknown
+        self.mu[racer_ids] = [row[1] for row in rows]
+        self.sigma[racer_ids] = [row[2] for row in rows]
+        self.category[racer_ids] = [-1 if row[3] is None else row[3]
+                                    for row in rows]
+        self.dirty = np.zeros(size, dtype=bool)
+
+    @classmethod
+    def from_arrays(cls, mu, sigma, category):
+        """A store with the given ratings and racer categories (-1 for
+        unknown), indexed by RacerID, without reading the Racers table."""
+        store = cls.__new__(cls)
+        store.mu = np.array(mu, dtype=np.float64)
+        store.sigma = np.array(sigma, dtype=np.float64)
+        store.category = np.array(category, dtype=np.int64)
+        store.dirty = np.zeros(len(store.mu), dtype=bool)
+        return store
+
+    def get(self, racer_ids):
+        """Returns arrays of the current mus and sigmas for the racer_ids."""
+        return self.mu[racer_ids], self.sigma[racer_ids]
+
+    def set(self, racer_ids, mus, sigmas):
+        """Updates the ratings for the racer_ids."""
+        self.mu[racer_ids] = mus
+        self.sigma[racer_ids] = sigmas
+        self.dirty[racer_ids] = True
+
+    @staticmethod
+    def empty_stats():
+        """Returns RatingStats rows for when no racers have been rated."""
+        return [{'scope': 'all', 'count': 0, 'total': 0, 'total_sq': 0,
+                 'histogram': [0] * (len(RatingStats.BIN_EDGES) - 1)}]
+
+    def get_stats(self):
+        """Returns RatingStats rows (dictionaries) for the current ratings of
+        rated racers, i.e. those without the default mu.
+        """
+        rated = self.mu != env.mu
+        scopes = [('all', rated)]
+        scopes += [(f'Category {category}', rated & (self.category == category))
+                   for category in np.unique(self.category[rated])
+                   if category >= 0]
+
+        edges = np.array(RatingStats.BIN_EDGES, dtype=np.float64)
+        rows = []
+        for scope, mask in scopes:
+            mus = self.mu[mask]
+            histogram, _ = np.histogram(np.clip(mus, edges[0], edges[-1]),
+                                        bins=edges)
+            rows.append({'scope': scope,
+                         'count': len(mus),
+                         'total': float(mus.sum()),
+                         'total_sq': float((mus ** 2).sum()),
+                         'histogram': histogram.tolist()})
+        return rows
+
+    def write_back(self, batch_size=10000, commit=True):
+        """Writes changed ratings to the Racers table in batches of
+        bulk updates.
+        """
+        racer_ids = np.flatnonzero(self.dirty)
+        print(f'Writing ratings for {len(racer_ids)} racers...')
+        for i in range(0, len(racer_ids), batch_size):
+            batch = racer_ids[i:i + batch_size]
+            Racers.update([{'RacerID': int(racer_id),
+                            'mu': float(self.mu[racer_id]),
+                            'sigma': float(self.sigma[racer_id])}
+                           for racer_id in batch], commit=False)
+        self.dirty[:] = False
+        if commit:
+            db.session.flush()
+            db.session.commit()
+
+
+def get_new_results(query):
+    """Filters a query of Results joined with Races down to the race
+    categories that have not been rated yet: those after the checkpoint of
+    the last rating run (if it matches the rated results), which includes
+    uncontested categories with no rated results. Categories from older
+    races can only be rated in order by resetting and re-rating everything,
+    so they are skipped.
+    """
+    rated = aliased(Results)
+    unrated = query.filter(~exists().where(
+        and_(rated.race_id == Results.race_id,
+             rated.RaceCategoryName == Results.RaceCategoryName,
+             rated.rated)))
+    key = tuple_(Races.date, Results.race_id, Results.RaceCategoryName)
+
+    checkpoint = Checkpoints.load('ratings')
+    if checkpoint:
+        processed = key <= tuple_(checkpoint.date, checkpoint.race_id,
+                                  checkpoint.RaceCategoryName)
+        # Processed results all have a predicted place. If none before the
+        # checkpoint do, it is left from results that have since been
+        # dropped and added again, so it is ignored.
+        if not query.filter(processed,
+                            Results.predicted_place != None).first():
+            checkpoint = None
+    if checkpoint:
+        num_skipped = unrated.filter(processed,
+                                     Results.predicted_place == None).count()
+        if num_skipped:
+            print(f'Skipping {num_skipped} unrated results before race '
+                  f'{checkpoint.race_id} category '
+                  f'{checkpoint.RaceCategoryName} - reset and re-rate to '
+                  'include them')
+        return unrated.filter(~processed)
+
+    # No (valid) checkpoint: fall back to the date of the most recent rated race
+    last_date = (db.session.query(func.max(Races.date))
+                           .join(Results, Races.race_id == Results.race_id)
+                           .filter(Results.rated)
+                           .scalar())
+    if last_date is None:  # nothing rated yet
+        return unrated
+
+    num_skipped = unrated.filter(Races.date < last_date).count()
+    if num_skipped:
+        print(f'Skipping {num_skipped} unrated results older than {last_date}'
+              ' - reset and re-rate to include them')
+    return unrated.filter(Races.date >= last_date)
 
 
 def get_predicted_places(results):
     """Gets the predicted place for each racer in a set of results. Placing
        order determined by decreasing mean rating."""
-
-    ranks = rankdata([-x.prior_mu for x in results], method='min')
+    ranks = predict_places([x.prior_mu for x in results])
     for result, rank in zip(results, ranks):
         result.predicted_place = int(rank) # convert from numpy dtype
 
 
+def predict_places(mus):
+    """Returns an array of predicted places for racers with the given mean
+    ratings, by decreasing mean rating, with ties sharing the best place."""
+    from scipy.stats import rankdata  # slow to import; only needed here
+
+    return rankdata(-np.asarray(mus, dtype=np.float64), method='min')
+
+
 def reset_ratings():
     """Reset all ratings to default values."""
     defaults = {'mu': env.mu, 'sigma': env.sigma, 'rated': False,
@@ -107,32 +417,131 @@ def reset_ratings():
     print('Resetting ratings in Results...')
     Results.query.update(defaults, synchronize_session=False)
 
+    defaults = {'mu': env.mu, 'sigma': env.sigma,
+                'prior_mu': env.mu, 'prior_sigma': env.sigma}
+    print('Resetting ratings in RacerHistory...')
+    RacerHistory.query.update(defaults, synchronize_session=False)
+
     defaults = {'mu': env.mu, 'sigma': env.sigma}
     print('Resetting ratings in Racers...')
     Racers.query.update(defaults, synchronize_session=False)
+    RatingStats.replace(RatingStore.empty_stats())
+    Counters.increment('ratings_version')
+    Checkpoints.clear('ratings')
     db.session.flush()
     db.session.commit()
 
 
-def run_trueskill(results):
+def run_trueskill(results, backend=None):
     """Runs TrueSkill on the race results, where prior ratings are stored
     in prior_mu and prior_sigma attributes for each row in the results.
     Returns a list of updated results dictionary mappings for each row.
     Returns [] if the rating is uncontested and the results are not updated.
+
+    backend is 'numpy' or 'mpmath' (Default: config.RATING_BACKEND). The numpy
+    engine falls back to mpmath for races that raise a FloatingPointError.
     """
+    return rate_race([result.prior_mu for result in results],
+                     [result.prior_sigma for result in results], backend)
+
+
+def rate_race(mus, sigmas, backend=None, env=env):
+    """Runs TrueSkill with the parameters of env on one race, given the prior
+    mus and sigmas of the racers in finishing order, like run_trueskill.
+    Returns a list of new Rating objects, or [] if the rating failed.
+    """
+    backend = backend or config.RATING_BACKEND
+
+    if backend == 'numpy':
+        try:
+            new_mus, new_sigmas = fastskill.rate(mus, sigmas, env.beta,
+                                                 env.tau)
+            return [env.Rating(float(mu), float(sigma))
+                        for mu, sigma in zip(new_mus, new_sigmas)]
+        except FloatingPointError as e:
+            print(f'{e}; falling back to mpmath')
 
     # TrueSkill requires each "team" as a list. Our teams are one person each
     # and consist of one rating. We then need to get the only element from the
     # returned list to access the updated ratings
+    new_ratings = []
     try:
-        new_ratings = env.rate([
-            [env.Rating(result.prior_mu, result.prior_sigma)]
-            for result in results])
+        new_ratings = env.rate([[env.Rating(float(mu), float(sigma))]
+                                for mu, sigma in zip(mus, sigmas)])
         new_ratings = [rating[0] for rating in new_ratings]
     except FloatingPointError as e:
         import dill
-        dill.dump([(result.prior_mu, result.prior_sigma) for result in results],
-                    open('error.pkl', 'wb'))
+        dill.dump([(float(mu), float(sigma))
+                   for mu, sigma in zip(mus, sigmas)],
+                  open('error.pkl', 'wb'))
         print(e)
 
     return new_ratings
+
+
+def check_backends(num_races=100, max_racers=100, seed=0):
+    """Rates randomly generated races with both the numpy and mpmath
+    backends and returns the largest difference in any updated mu or sigma.
+    """
+    rng = np.random.default_rng(seed)
+    max_diff = 0
+    for _ in range(num_races):
+        n = rng.integers(2, max_racers, endpoint=True)
+        results = [SimpleNamespace(prior_mu=mu, prior_sigma=sigma)
+                   for mu, sigma in zip(rng.normal(env.mu, env.sigma / 2, n),
+                                        rng.uniform(1, env.sigma, n))]
+        fast = run_trueskill(results, backend='numpy')
+        slow = run_trueskill(results, backend='mpmath')
+        for a, b in zip(fast, slow):
+            max_diff = max(max_diff, abs(a.mu - float(b.mu)),
+                           abs(a.sigma - float(b.sigma)))
+    print(f'Largest difference between backends: {max_diff}')
+    return max_diff
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def check_resume(processes=4, chunk_size=7):
+    """Rates all results serially, then again from scratch in parallel,
+    crashing right after the first commit and resuming from its checkpoint,
+    and returns the number of results whose ratings differ between the two
+    runs. chunk_size should be small enough that the first commit falls
+    inside a wave (see rate_in_parallel). Replaces all ratings.
+    """
+    cols = [Results.ResultID, Results.prior_mu, Results.prior_sigma,
+            Results.mu, Results.sigma, Results.predicted_place, Results.rated]
+
+    def get_results():
+        return {row[0]: row[1:] for row in
+                Results.query.with_entities(*cols)}
+
+    reset_ratings()
+    get_all_ratings(processes=1)
+    expected = get_results()
+
+    global commit_ratings
+    commit = commit_ratings
+
+    def commit_and_crash(*args, **kwargs):
+        commit(*args, **kwargs)
+        raise SimulatedCrash()
+
+    reset_ratings()
+    commit_ratings = commit_and_crash
+    try:
+        get_all_ratings(processes=processes, chunk_size=chunk_size)
+    except SimulatedCrash:
+        print('Crashed after the first commit; resuming')
+    finally:
+        commit_ratings = commit
+    get_all_ratings(processes=processes, chunk_size=chunk_size, resume=True)
+    actual = get_results()
+
+    num_diff = sum(not np.allclose(np.array(actual[key], dtype=float),
+                                   np.array(row, dtype=float), rtol=0,
+                                   atol=1e-9)
+                   for key, row in expected.items())
+    print(f'{num_diff} of {len(expected)} results differ from a serial run')
+    return num_diff
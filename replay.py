@@ -0,0 +1,167 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import config
+import ratings
+import snapshot
+from database import db
+from metrics import metrics
+from model import (Results, Racers, RacerHistory, Checkpoints, RatingStats,
+                   Counters)
+
+
+def get_boundaries(results):
+    """Offsets of the first result of each race category in results (in
+    rating order, see snapshot.export), followed by the number of results.
+    """
+    race_ids = results['race_id']
+    categories = results['RaceCategoryName']
+    if not len(race_ids):
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero((race_ids[1:] != race_ids[:-1])
+                            | (categories[1:] != categories[:-1])) + 1
+    return np.concatenate([[0], starts, [len(race_ids)]])
+
+
+def replay(results, store, env=ratings.env, backend=None):
+    """Rates every result in results (a snapshot ColumnStore, or a
+    dictionary of its RacerID, race_id, RaceCategoryName and Place arrays)
+    in order, one race category at a time, starting from the ratings in
+    store (see ratings.RatingStore), which are updated as racers are rated.
+
+    This is the same rating as ratings.get_all_ratings (using its
+    ratings.rate_race and ratings.predict_places), but entirely in arrays:
+    returns a namespace of prior_mu, prior_sigma, mu, sigma,
+    predicted_place and rated arrays in the order of results, and the
+    number of categories rated. TrueSkill uses the parameters of env.
+    """
+    racer_ids = np.asarray(results['RacerID'])
+    placing = np.asarray(results['Place']) != -1  # DNFs have no place
+    boundaries = get_boundaries(results)
+    prior_mu = np.empty(len(racer_ids))
+    prior_sigma = np.empty(len(racer_ids))
+    mu = np.empty(len(racer_ids))
+    sigma = np.empty(len(racer_ids))
+    predicted_place = np.empty(len(racer_ids), dtype=np.int32)
+    rated = np.zeros(len(racer_ids), dtype=bool)
+
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        ids = racer_ids[start:end]
+        mus, sigmas = store.get(ids)
+        prior_mu[start:end] = mus
+        prior_sigma[start:end] = sigmas
+        mu[start:end] = mus  # unchanged for DNF and unrated racers
+        sigma[start:end] = sigmas
+
+        # Predicted place for all racers (including DNFs)
+        predicted_place[start:end] = ratings.predict_places(mus)
+
+        mask = placing[start:end]
+        if mask.sum() > 1:  # don't rate uncontested races
+            new_ratings = ratings.rate_race(mus[mask], sigmas[mask], backend,
+                                            env)
+            if new_ratings:  # rating succeeded
+                new_mus, new_sigmas = np.array(
+                    [(float(rating.mu), float(rating.sigma))
+                     for rating in new_ratings]).T
+                store.set(ids[mask], new_mus, new_sigmas)
+                mu[start:end][mask] = new_mus
+                sigma[start:end][mask] = new_sigmas
+                rated[start:end] = mask
+
+    return SimpleNamespace(prior_mu=prior_mu, prior_sigma=prior_sigma, mu=mu,
+                           sigma=sigma, predicted_place=predicted_place,
+                           rated=rated, num_categories=len(boundaries) - 1)
+
+
+def get_store(snap, env=ratings.env):
+    """A RatingStore with the default rating of env for every racer in the
+    snapshot, i.e. the store after ratings.reset_ratings."""
+    racer_ids = np.asarray(snap.racers['RacerID'])
+    size = max(racer_ids.max(initial=-1),
+               np.asarray(snap.results['RacerID']).max(initial=-1)) + 1
+    category = np.full(size, -1, dtype=np.int64)
+    category[racer_ids] = snap.racers['Category']
+    return ratings.RatingStore.from_arrays(np.full(size, env.mu),
+                                           np.full(size, env.sigma), category)
+
+
+def write_ratings(snap, outcome, store):
+    """Writes the ratings from replay to the Results, RacerHistory and
+    Racers tables with one bulk COPY and UPDATE each (see
+    Model.copy_update), and commits them together with the rating stats and
+    a checkpoint for the last category, as ratings.commit_ratings does.
+    """
+    results = snap.results
+    frame = pd.DataFrame({'ResultID': results['ResultID'],
+                          'prior_mu': outcome.prior_mu,
+                          'prior_sigma': outcome.prior_sigma,
+                          'mu': outcome.mu,
+                          'sigma': outcome.sigma,
+                          'predicted_place': outcome.predicted_place,
+                          'rated': outcome.rated})
+    print(f'Updated {Results.copy_update(frame, commit=False)} results')
+    print(f'Updated {RacerHistory.copy_update(frame, commit=False)} '
+          'racer history rows')
+
+    racer_ids = np.asarray(snap.racers['RacerID'])
+    frame = pd.DataFrame({'RacerID': racer_ids,
+                          'mu': store.mu[racer_ids],
+                          'sigma': store.sigma[racer_ids]})
+    print(f'Updated {Racers.copy_update(frame, commit=False)} racers')
+
+    RatingStats.replace(store.get_stats())
+    Counters.increment('ratings_version')
+    if len(results):
+        Checkpoints.save(
+            'ratings', date=pd.Timestamp(results['date'][-1]).to_pydatetime(),
+            race_id=int(results['race_id'][-1]),
+            RaceCategoryName=results.strings('RaceCategoryName')[-1])
+    else:
+        Checkpoints.clear('ratings')
+    db.session.flush()
+    db.session.commit()
+
+
+def replay_ratings(directory=config.SNAPSHOT_DIR, export=False, backend=None):
+    """Re-rates every result from scratch, like ratings.reset_ratings
+    followed by ratings.get_all_ratings, but reading the results from the
+    columnar snapshot in directory (see snapshot.export) and rating them in
+    memory (see replay), so that the database is only touched to write the
+    ratings back in one pass at the end. The new ratings are also saved in
+    the snapshot.
+
+    If export, new results are first added to the snapshot. Raises
+    RuntimeError if the snapshot does not have the same number of results
+    as the database, since results missing from it would keep stale
+    ratings.
+    """
+    time0 = time.time()
+    snap = snapshot.export(directory) if export else snapshot.load(directory)
+    if len(snap.results) != Results.count():
+        raise RuntimeError(f'The snapshot in {directory} has '
+                           f'{len(snap.results)} results but the database '
+                           f'has {Results.count()}; export it again.')
+
+    store = get_store(snap)
+    outcome = replay(snap.results, store, backend=backend)
+    metrics.inc('rating_categories_total', outcome.num_categories)
+    metrics.inc('rating_results_total', len(snap.results))
+    ratings.set_throughput(outcome.num_categories, len(snap.results), time0)
+    print(f'Rated {outcome.num_categories} categories in memory: '
+          f'{time.time() - time0}')
+
+    write_ratings(snap, outcome, store)
+    snap.results.update(prior_mu=outcome.prior_mu,
+                        prior_sigma=outcome.prior_sigma, mu=outcome.mu,
+                        sigma=outcome.sigma,
+                        predicted_place=outcome.predicted_place,
+                        rated=outcome.rated)
+    snap.results.update_meta(ratings_version=Counters.get_cache_version())
+    racer_ids = np.asarray(snap.racers['RacerID'])
+    snap.racers.update(mu=store.mu[racer_ids], sigma=store.sigma[racer_ids])
+    print(f'Wrote ratings: {time.time() - time0}')
+    return outcome
@@ -1,9 +1,15 @@
-import re
+import asyncio
 import json
+import queue
+import random
+import re
+import threading
 
+import aiohttp
 from datetime import datetime
-from requests_futures.sessions import FuturesSession
 
+import config
+from cache import PageCache
 from preprocess import clean
 
 # Finds the appropriate HTML tag and following text
@@ -13,17 +19,187 @@ date_regex = re.compile(r'([A-Za-z]{3})\s+(\d{1,2})\s+(\d{4})')
 
 BAD_IDS = [12534, 12535]  # these didn't work - ignoring
 
+# Responses that mean we should back off and try again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AdaptiveLimit:
+    """Async context manager limiting the number of requests in flight.
+    The limit grows by about one for each limit's worth of successful
+    requests and halves whenever the server pushes back (additive increase,
+    multiplicative decrease).
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.limit = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.active = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.active < int(self.limit))
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def throttled(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
 
-def get_futures(race_ids=list(range(1, 13000))):
-    """Get Futures for all BikeReg race pages with given race_ids."""
-    session = FuturesSession(max_workers=8)
-    return [session.get(f'https://results.bikereg.com/race/{race_id}')
-                for race_id in race_ids if race_id not in BAD_IDS]
+async def fetch(session, limit, url, retries=4, backoff=1):
+    """Get the text of the page at url. Retries with jittered exponential
+    backoff after connection errors, timeouts and throttling responses.
+    Returns None if the request fails.
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with limit:
+                async with session.get(url) as response:
+                    if response.status not in RETRY_STATUSES:
+                        if response.status >= 400:
+                            print(f'Got status {response.status} for {url}')
+                            return None
+                        text = await response.text()
+                        limit.succeeded()
+                        return text
+            print(f'Got status {response.status} for {url}, retrying')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Got {e!r} for {url}, retrying')
+        limit.throttled()
+        if attempt < retries:
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+    print(f'Giving up on {url}')
+    return None
+
+
+async def _fetch_all(items, output, stop, base_url, cache, cache_if, max_age,
+                     concurrency, max_concurrency, timeout, **kwargs):
+    """Fetches each (key, path) in items, starting at most max_concurrency
+    requests ahead of the consumer, and puts (key, text) tuples in the output
+    queue as the requests complete. Stops as soon as the stop event is set.
+    """
+    limit = AdaptiveLimit(concurrency, max_concurrency)
+
+    async def fetch_item(key, path):
+        text = cache.get(path, max_age=max_age) if cache else None
+        if text is None:
+            text = await fetch(session, limit, base_url + path, **kwargs)
+            if cache and text is not None and cache_if(text):
+                cache.put(path, text)
+        return key, text
+
+    async def put(tasks):
+        for task in tasks:
+            # Wait for room in the queue without blocking the event loop,
+            # giving up if the consumer stops
+            while not stop.is_set():
+                try:
+                    output.put_nowait(task.result())
+                    break
+                except queue.Full:
+                    await asyncio.sleep(0.05)
+
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(timeout=client_timeout) as session:
+        pending = set()
+        try:
+            for key, url in items:
+                if stop.is_set():
+                    return
+                if len(pending) >= max_concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    await put(done)
+                pending.add(asyncio.ensure_future(fetch_item(key, url)))
+            while pending and not stop.is_set():
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                await put(done)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def fetch_all(items, base_url=config.SCRAPE_BASE_URL, use_cache=True,
+              cache_if=lambda text: True, max_age=config.CACHE_MAX_AGE,
+              concurrency=8, max_concurrency=32, timeout=60, **kwargs):
+    """Fetch the text of each (key, path) in items, where path is relative to
+    base_url. Returns a generator of (key, text) tuples in the order the
+    requests complete, where text is None for failed requests. The requests
+    run in an asyncio event loop in a background thread, with the number of
+    requests in flight adapting between 1 and max_concurrency to how fast
+    the server responds.
+
+    If use_cache, pages are read from the on-disk PageCache when they were
+    fetched less than max_age seconds ago (None for no limit), and
+    downloaded pages for which cache_if(text) is true are added to it.
+
+    If the consumer stops iterating (e.g. because it raised), no more
+    requests are started and the background thread exits.
+    """
+    output = queue.Queue(maxsize=max_concurrency)
+    cache = PageCache() if use_cache else None
+    done = object()
+    stop = threading.Event()  # set when the consumer stops iterating
+
+    def finish(item):
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            asyncio.run(_fetch_all(items, output, stop, base_url, cache,
+                                   cache_if, max_age, concurrency,
+                                   max_concurrency, timeout, **kwargs))
+        except Exception as e:
+            finish(e)
+        finally:
+            finish(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item = output.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def get_race_pages(race_ids=list(range(1, 13000)), **kwargs):
+    """Get (race_id, text) for all BikeReg race pages with given race_ids,
+    in the order they are downloaded. Pages for races without results yet
+    are not cached.
+    """
+    return fetch_all(((race_id, f'/race/{race_id}')
+                      for race_id in race_ids if race_id not in BAD_IDS),
+                     cache_if=lambda text: 'No data' not in text,
+                     **kwargs)
+
+def get_results_pages(race_ids, urls, **kwargs):
+    """Get (race_id, text) for all BikeReg JSON pages with given race_ids and
+    json_urls, in the order they are downloaded.
+    """
+    return fetch_all(((race_id, f'/{url}')
+                      for race_id, url in zip(race_ids, urls)),
+                     **kwargs)
 
-def get_results_futures(urls):
-    """Get Futures for all BikeReg JSON pages with given json_urls."""
-    session = FuturesSession(max_workers=8)
-    return [session.get(f'https://results.bikereg.com/{url}') for url in urls]
 
 def get_metadata(race_page_text):
     """Extract metadata from BikeReg race results page text,
@@ -65,8 +241,13 @@ def scrape_race_page(race_id, text):
     return {}
 
 
-def scrape_results_json(race_id, text):
-    """Scrapes BikeReg results from JSON."""
+def parse_results_json(race_id, text):
+    """Parses BikeReg results from JSON into a list of uncleaned rows."""
     rows = json.loads(text)
     [row.update({'race_id': race_id}) for row in rows]
-    return clean(rows)
+    return rows
+
+
+def scrape_results_json(race_id, text):
+    """Scrapes BikeReg results from JSON."""
+    return clean(parse_results_json(race_id, text))
@@ -0,0 +1,127 @@
+import time
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+import config
+from model import Races, Racers
+
+
+class SuggestionIndex:
+    """In-memory index of strings (e.g. racer names) for search suggestions.
+    Matches are case-insensitive substrings ranked by how well they match:
+    names starting with the query (exact matches first), then names with a
+    word starting with the query, then names containing the query anywhere.
+    Prefix matches are sorted alphabetically.
+    """
+
+    def __init__(self, values=()):
+        self.values = []  # original strings, indexed by id
+        self._keys = []  # lowercase strings, indexed by id
+        self._seen = set()
+        self._names = []  # sorted (lowercase string, id) for prefix search
+        self._words = []  # sorted (lowercase word, id) for word prefixes
+        self._trigrams = defaultdict(lambda: array('I'))  # trigram -> ids
+        self.add(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, values):
+        """Add new strings to the index. Repeated strings are ignored."""
+        for value in values:
+            if value is None or value in self._seen:
+                continue
+            self._seen.add(value)
+            i = len(self.values)
+            key = value.lower()
+            self.values.append(value)
+            self._keys.append(key)
+            self._names.append((key, i))
+            self._words.extend((word, i) for word in set(key.split()[1:]))
+            for trigram in {key[j:j + 3] for j in range(len(key) - 2)}:
+                self._trigrams[trigram].append(i)
+        self._names.sort()
+        self._words.sort()
+
+    def _prefixed(self, entries, query):
+        """Ids for sorted (string, id) entries whose string starts with
+        query, in order."""
+        j = bisect_left(entries, (query,))
+        while j < len(entries) and entries[j][0].startswith(query):
+            yield entries[j][1]
+            j += 1
+
+    def _containing(self, query):
+        """Ids for strings containing query (at least three characters), in
+        the order they were added. Only strings with the query's rarest
+        trigram are checked."""
+        trigrams = [query[j:j + 3] for j in range(len(query) - 2)]
+        postings = [self._trigrams.get(trigram, ()) for trigram in trigrams]
+        for i in min(postings, key=len):
+            if query in self._keys[i]:
+                yield i
+
+    def search(self, query, limit=5):
+        """Returns up to limit strings matching query, best matches first."""
+        query = query.lower().strip()
+        if not query:
+            return []
+
+        matches, seen = [], set()
+        groups = [self._prefixed(self._names, query),
+                  self._prefixed(self._words, query)]
+        if len(query) >= 3:
+            groups.append(self._containing(query))
+        for group in groups:
+            for i in group:
+                if i not in seen:
+                    seen.add(i)
+                    matches.append(self.values[i])
+                    if len(matches) >= limit:
+                        return matches
+        return matches
+
+
+def race_names():
+    """Races as they appear in search suggestions, e.g.
+    'Tour of Somerville (2019-05-27)'."""
+    return ('{} ({})'.format(name, date.strftime('%Y-%m-%d'))
+            for name, date in Races.query.with_entities(Races.name,
+                                                        Races.date)
+            if date)
+
+
+def racer_names():
+    """Racer names for search suggestions."""
+    return (name for name, in Racers.query.with_entities(Racers.Name))
+
+
+LOADERS = {'race_name': race_names, 'racer_name': racer_names}
+
+_indexes = {}  # search box -> (SuggestionIndex, time built)
+
+
+def get_index(box):
+    """Get the SuggestionIndex for the given search box, building it if
+    needed. Indexes are rebuilt after config.SEARCH_INDEX_TTL seconds so
+    that workers pick up new races and racers added elsewhere.
+    """
+    index, built = _indexes.get(box, (None, 0))
+    if index is None or time.time() - built > config.SEARCH_INDEX_TTL:
+        index = SuggestionIndex(LOADERS[box]())
+        _indexes[box] = (index, time.time())
+    return index
+
+
+def get_suggestions(box, query, limit=5):
+    """Returns a list of search suggestions for the given search box
+    ('race_name' or 'racer_name') and query."""
+    return get_index(box).search(query, limit=limit)
+
+
+def refresh():
+    """Forget the indexes so they are rebuilt on the next search, e.g. after
+    adding races or racers."""
+    _indexes.clear()
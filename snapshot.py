@@ -0,0 +1,254 @@
+import json
+import os
+import shutil
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import func, tuple_
+
+import config
+from database import db
+from model import Races, Results, Racers, Counters
+
+# Column types of each table in the snapshot. 'dictionary' columns are
+# strings stored as int32 codes into a list of distinct values. Missing
+# integers are stored as -1, missing strings as code -1 and missing dates as
+# NaT.
+SCHEMAS = {
+    'results': {'ResultID': 'int64',
+                'RacerID': 'int64',
+                'race_id': 'int32',
+                'RaceCategoryName': 'dictionary',
+                'Place': 'int32',
+                'date': 'datetime64[s]',
+                'Category': 'int32',
+                'prior_mu': 'float64',
+                'prior_sigma': 'float64',
+                'mu': 'float64',
+                'sigma': 'float64',
+                'predicted_place': 'int32',
+                'rated': 'bool'},
+    'races': {'race_id': 'int32',
+              'name': 'dictionary',
+              'date': 'datetime64[s]',
+              'loc': 'dictionary'},
+    'racers': {'RacerID': 'int64',
+               'Name': 'dictionary',
+               'Category': 'int32',
+               'mu': 'float64',
+               'sigma': 'float64',
+               'num_races': 'int32'},
+}
+
+
+class ColumnStore:
+    """A table stored in a directory as one raw binary file per column,
+    which are memory-mapped when read, plus a manifest.json with the number
+    of rows and the column types (see SCHEMAS). Rows are only ever
+    appended; the manifest is written last, so an interrupted append leaves
+    the previous rows intact.
+    """
+
+    def __init__(self, directory, schema):
+        self.directory = directory
+        self.schema = schema
+        self.num_rows = 0
+        self.meta = {}  # e.g. the last key in the table
+        self._vocab = {col: [] for col, kind in schema.items()
+                       if kind == 'dictionary'}
+        self._codes = {col: {} for col in self._vocab}
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest['schema'] == schema:
+                self.num_rows = manifest['num_rows']
+                self.meta = manifest['meta']
+                for col in self._vocab:
+                    with open(self._path(col, 'vocab.json')) as f:
+                        self._vocab[col] = json.load(f)
+                    self._codes[col] = {value: code for code, value
+                                        in enumerate(self._vocab[col])}
+
+    def __len__(self):
+        return self.num_rows
+
+    def _path(self, col, ext='bin'):
+        return os.path.join(self.directory, f'{col}.{ext}')
+
+    def _dtype(self, col):
+        kind = self.schema[col]
+        return np.dtype('int32' if kind == 'dictionary' else kind)
+
+    def __getitem__(self, col):
+        """The column as a read-only memory-mapped array (codes for
+        dictionary columns)."""
+        if not self.num_rows:
+            return np.empty(0, self._dtype(col))
+        return np.memmap(self._path(col), dtype=self._dtype(col), mode='r',
+                         shape=(self.num_rows,))
+
+    def vocab(self, col):
+        """The distinct values of a dictionary column, indexed by code."""
+        return self._vocab[col]
+
+    def strings(self, col):
+        """The decoded values of a dictionary column (None if missing)."""
+        values = np.array(self._vocab[col] + [None], dtype=object)
+        return values[self[col]]  # code -1 is the None at the end
+
+    def clear(self):
+        """Delete all rows."""
+        shutil.rmtree(self.directory)
+        self.__init__(self.directory, self.schema)
+
+    def append(self, frame, **meta):
+        """Append the rows of a DataFrame with the schema's columns, and
+        update the metadata with meta."""
+        for col, kind in self.schema.items():
+            values = frame[col]
+            if kind == 'dictionary':
+                codes, uniques = pd.factorize(values)
+                mapping = np.array([self._codes[col].setdefault(
+                                        value, len(self._codes[col]))
+                                    for value in uniques] + [-1],
+                                   dtype='int32')
+                array = mapping[codes]  # code -1 (missing) maps to -1
+            elif kind.startswith('datetime64'):
+                array = pd.to_datetime(values).to_numpy().astype(kind)
+            elif kind.startswith('int'):
+                array = values.fillna(-1).to_numpy().astype(kind)
+            elif kind == 'bool':
+                array = values.fillna(False).to_numpy().astype(kind)
+            else:
+                array = values.to_numpy().astype(kind)
+            with open(self._path(col), 'r+b' if self.num_rows else 'wb') as f:
+                f.seek(self.num_rows * self._dtype(col).itemsize)
+                f.truncate()
+                f.write(np.ascontiguousarray(array).tobytes())
+
+        self.num_rows += len(frame)
+        self.meta.update(meta)
+        self._write_manifest()
+
+    def update(self, **columns):
+        """Overwrite whole (non-dictionary) columns in place with arrays of
+        len(self) values, e.g. new ratings for every result."""
+        for col, values in columns.items():
+            array = np.asarray(values).astype(self._dtype(col))
+            if len(array) != self.num_rows:
+                raise ValueError(f'{col} has {len(array)} values, '
+                                 f'not {self.num_rows}')
+            if not self.num_rows:
+                continue
+            with open(self._path(col), 'r+b') as f:
+                f.write(np.ascontiguousarray(array).tobytes())
+
+    def update_meta(self, **meta):
+        """Update the metadata without adding rows."""
+        self.meta.update(meta)
+        self._write_manifest()
+
+    def _write_manifest(self):
+        for col, codes in self._codes.items():
+            self._vocab[col] = list(codes)  # insertion order = code order
+            with open(self._path(col, 'vocab.json'), 'w') as f:
+                json.dump(self._vocab[col], f)
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'num_rows': self.num_rows, 'schema': self.schema,
+                       'meta': self.meta}, f, default=str)
+        os.replace(path + '.tmp', path)
+
+
+def load(directory=config.SNAPSHOT_DIR):
+    """Open the snapshot in directory. Returns a namespace of ColumnStores
+    for results (in rating order), races and racers, whose columns are
+    memory-mapped: nothing is read until it is used.
+    """
+    return SimpleNamespace(**{name: ColumnStore(os.path.join(directory, name),
+                                                schema)
+                              for name, schema in SCHEMAS.items()})
+
+
+def read_chunks(query, chunk_size):
+    """Stream the rows of query as DataFrames of chunk_size rows."""
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        yield from pd.read_sql(query.statement, connection,
+                               chunksize=chunk_size)
+    finally:
+        connection.close()
+
+
+def export(directory=config.SNAPSHOT_DIR, append=True, chunk_size=100000):
+    """Export the Results, Races and Racers tables to a columnar snapshot
+    in directory (see load). Results are sorted in rating order (race date,
+    race, category and place; see ratings.get_ordered_results).
+
+    If append, only results in race categories after the last one in the
+    snapshot are added, so new races are cheap to add. The whole snapshot
+    is rebuilt instead if results were added to or removed from categories
+    already in the snapshot (e.g. a race older than the newest one was
+    added), or if the ratings changed since it was exported (see
+    Counters.get_cache_version), since the results include their ratings.
+    Races and racers are always rewritten, since they are small and their
+    ratings change.
+    """
+    time0 = time.time()
+    snapshot = load(directory)
+    key = (Races.date, Results.race_id, Results.RaceCategoryName)
+    query = (db.session
+               .query(*[getattr(Results, col) for col in SCHEMAS['results']
+                        if col != 'date'], Races.date)
+               .join(Races, Races.race_id == Results.race_id))
+
+    results = snapshot.results
+    last = results.meta.get('last_key')
+    version = Counters.get_cache_version()
+    if append and last and results.meta.get('ratings_version') != version:
+        print('Ratings changed since the snapshot was exported; rebuilding it')
+        results.clear()
+    elif append and last:
+        last = (pd.Timestamp(last[0]).to_pydatetime(), last[1], last[2])
+        num_before, = (db.session.query(func.count(Results.ResultID))
+                                 .join(Races,
+                                       Races.race_id == Results.race_id)
+                                 .filter(tuple_(*key) <= tuple_(*last))
+                                 .one())
+        if num_before == len(results):
+            query = query.filter(tuple_(*key) > tuple_(*last))
+        else:
+            print('Results changed in categories already in the snapshot; '
+                  'rebuilding it')
+            results.clear()
+    else:
+        results.clear()
+
+    num_rows = len(results)
+    query = query.order_by(*key, Results.Place)
+    for chunk in read_chunks(query, chunk_size):
+        row = chunk.iloc[-1]
+        results.append(chunk, last_key=[row['date'].isoformat(),
+                                        int(row['race_id']),
+                                        row['RaceCategoryName']],
+                       ratings_version=version)
+        print(f'Exported {len(results)} results: {time.time() - time0}')
+    print(f'Added {len(results) - num_rows} results')
+
+    for name, Table in [('races', Races), ('racers', Racers)]:
+        store = getattr(snapshot, name)
+        store.clear()
+        query = (Table.query
+                      .with_entities(*[getattr(Table, col)
+                                       for col in SCHEMAS[name]])
+                      .order_by(Table.index))
+        for chunk in read_chunks(query, chunk_size):
+            store.append(chunk)
+        print(f'Exported {len(store)} {name}: {time.time() - time0}')
+    return snapshot
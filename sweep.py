@@ -0,0 +1,101 @@
+import itertools
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import trueskill as ts
+
+import config
+import evaluation
+import ratings
+import replay
+import snapshot
+
+REPORT_PATH = os.path.join(config.basedir, 'sweep_report.csv')
+
+# Default grid: multiples of the parameters of ratings.env
+BETAS = tuple(ratings.env.beta * f for f in (0.5, 0.75, 1, 1.5, 2))
+TAUS = tuple(ratings.env.tau * f for f in (0.5, 1, 2, 4))
+SIGMAS = tuple(ratings.env.sigma * f for f in (0.5, 0.75, 1, 1.25))
+
+_snapshot = None  # the snapshot opened by each worker process
+
+
+def _open_snapshot(directory):
+    global _snapshot
+    _snapshot = snapshot.load(directory)
+
+
+def get_placings(results, outcome):
+    """The placings DataFrame of evaluation.get_placings for the results in
+    a snapshot, with the prior ratings and predicted places from a replay."""
+    placing = np.asarray(results['Place']) != -1
+    return pd.DataFrame({
+        'race_id': results['race_id'][placing],
+        'RaceCategoryName': results['RaceCategoryName'][placing],  # codes
+        'Place': results['Place'][placing],
+        'prior_mu': outcome.prior_mu[placing],
+        'predicted_place': outcome.predicted_place[placing]})
+
+
+def score(params, min_racers=5):
+    """Replays the results in the worker's snapshot with TrueSkill
+    parameters params = (beta, tau, sigma) and returns a dictionary of the
+    parameters and the evaluation metrics of the ratings (see
+    evaluation.get_metrics).
+    """
+    beta, tau, sigma = params
+    time0 = time.time()
+    env = ts.TrueSkill(mu=config.MU, sigma=sigma, beta=beta, tau=tau,
+                       backend='mpmath', draw_probability=0)
+    outcome = replay.replay(_snapshot.results,
+                            replay.get_store(_snapshot, env), env)
+    _, metrics = evaluation.get_metrics(get_placings(_snapshot.results,
+                                                     outcome),
+                                        min_racers=min_racers)
+    metrics = {name: np.nan if value is None else value  # nothing to score
+               for name, value in metrics.items()}
+    return {'beta': beta, 'tau': tau, 'sigma': sigma, **metrics,
+            'seconds': time.time() - time0}
+
+
+def run_sweep(betas=BETAS, taus=TAUS, sigmas=SIGMAS,
+              directory=config.SNAPSHOT_DIR, processes=None,
+              sort_by='mean_spearman', report_path=REPORT_PATH):
+    """Rates the whole race history in the columnar snapshot in directory
+    (see snapshot.export) once for every combination of the given TrueSkill
+    betas, taus and sigmas, in memory and in parallel across processes
+    (Default: one per CPU), without touching the database.
+
+    Returns a DataFrame with one row per configuration with its evaluation
+    metrics, best first by sort_by (e.g. 'mean_spearman' or
+    'top_1_accuracy'), which is also written to report_path as CSV.
+    """
+    time0 = time.time()
+    grid = list(itertools.product(betas, taus, sigmas))
+    if not len(snapshot.load(directory).results):
+        raise RuntimeError(f'The snapshot in {directory} has no results; '
+                           'export it first.')
+    print(f'Rating {len(grid)} configurations...')
+
+    rows = []
+    with multiprocessing.Pool(processes, initializer=_open_snapshot,
+                              initargs=(directory,)) as pool:
+        for row in pool.imap_unordered(score, grid):
+            rows.append(row)
+            print(f'[{len(rows)}/{len(grid)}] beta={row["beta"]:.4g} '
+                  f'tau={row["tau"]:.4g} sigma={row["sigma"]:.4g}: '
+                  f'{sort_by} {row[sort_by]:.4f} ({row["seconds"]:.1f} s)')
+
+    # Place and rating are negatively correlated when ratings predict well,
+    # so the most negative Spearman correlation is best
+    report = (pd.DataFrame(rows)
+                .sort_values(sort_by, ascending=sort_by.endswith('spearman'))
+                .reset_index(drop=True))
+    report.index += 1  # rank
+    report.to_csv(report_path, index_label='rank')
+    print(report.head(10).to_string())
+    print(f'Saved report to {report_path}: {time.time() - time0}')
+    return report
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+FIRST_NAMES = ['Alex', 'Anna', 'Ben', 'Carla', 'Chris', 'Dana', 'Eli', 'Emma',
+               'Frank', 'Grace', 'Hank', 'Ines', 'Jack', 'Kate', 'Liam', 'Maya',
+               'Nate', 'Olga', 'Paul', 'Quinn', 'Rosa', 'Sam', 'Tess', 'Umar',
+               'Vera', 'Will', 'Xena', 'Yuri', 'Zoe']
+LAST_NAMES = ['Adams', 'Baker', 'Clark', 'Davis', 'Evans', 'Fisher', 'Garcia',
+              'Hughes', 'Ito', 'Jones', 'Kim', 'Lopez', 'Miller', 'Nguyen',
+              "O'Brien", 'Patel', 'Quinn', 'Rossi', 'Smith', 'Taylor', 'Ueda',
+              'Vargas', 'Walsh', 'Young', 'Zhang']
+PLACES = ['Somerville', 'Greenfield', 'Lake Placid', 'Harlem', 'Bristol',
+          'Fitchburg', 'Cherry Pie', 'Battenkill', 'Killington', 'Rockville']
+EVENTS = ['Criterium', 'Road Race', 'Circuit Race', 'Grand Prix', 'Classic',
+          'Time Trial', 'Hill Climb']
+CATEGORIES = ['Men Cat 1/2', 'Men Cat 3', 'Men Cat 4', 'Men Cat 5',
+              'Women Cat 1/2/3', 'Women Cat 4/5', 'Masters 40+', 'Masters 50+',
+              'Juniors 15-18']
+
+START_DATE = datetime(2008, 1, 1)
+NUM_DAYS = 13 * 365
+
+
+def generate(num_results=10000, seed=0, racers_per_result=0.15,
+             participation_exponent=2, max_participation=500,
+             mean_category_size=25,
+             dnf_rate=0.08, dnp_rate=0.02, dq_rate=0.005, bad_name_rate=0.005):
+    """Generates a synthetic BikeReg dataset with about num_results results
+    for benchmarking. Returns (races, results): races are dictionaries like
+    those returned by scraping.scrape_race_page, and results are uncleaned
+    dictionaries like those returned by scraping.parse_results_json.
+
+    There are racers_per_result * num_results racers, and the number of
+    races each racer enters follows a power law with the given exponent
+    (capped at max_participation times the least active racers), so most
+    racers race once or twice and a few race hundreds of times. Category
+    sizes are lognormal with the given mean. Each racer has a latent skill
+    that determines their category and (with noise) their place. A fraction
+    of results are DNF, DNP or DQ, and a fraction of racers have names that
+    the cleaning step removes.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Split results into race categories, and categories into races
+    sizes = np.clip(rng.lognormal(np.log(mean_category_size) - 0.3, 0.8,
+                                  num_results // 2 + 1),
+                    2, 200).astype(int)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), num_results) + 1]
+    sizes[-1] -= max(0, sizes.sum() - num_results)
+    sizes = sizes[sizes > 0]
+    categories_per_race = rng.integers(1, 7, len(sizes))
+    race_of_category = np.repeat(np.arange(len(sizes)),
+                                 categories_per_race)[:len(sizes)]
+    num_races = race_of_category[-1] + 1
+
+    races = pd.DataFrame({'race_id': np.arange(1, num_races + 1)})
+    races['name'] = [f'{PLACES[i % len(PLACES)]} {EVENTS[i % len(EVENTS)]}'
+                     f' {i // (len(PLACES) * len(EVENTS)) + 1}'
+                     for i in rng.permutation(num_races)]
+    days = np.sort(rng.integers(0, NUM_DAYS, num_races))
+    races['date'] = [START_DATE + timedelta(days=int(d)) for d in days]
+    races['loc'] = [f'{PLACES[i]}, MA'
+                    for i in rng.integers(0, len(PLACES), num_races)]
+    races['json_url'] = [f'downloadrace.php?raceID={race_id}&json=1'
+                         for race_id in races['race_id']]
+
+    # Racers, with power-law participation weights
+    num_racers = max(10, int(racers_per_result * num_results))
+    # (small datasets have a lower cap so that categories are not full of
+    # the same few racers)
+    weights = np.minimum(rng.zipf(participation_exponent, num_racers),
+                         min(max_participation, num_racers // 10 + 1))
+    weights = weights / weights.sum()
+    skill = rng.normal(0, 1, num_racers)
+    racer_category = np.clip(np.digitize(-skill, [-1.5, -0.7, 0, 0.8]) + 1,
+                             1, 5)
+    first = np.array(FIRST_NAMES, dtype=object)[
+        rng.integers(0, len(FIRST_NAMES), num_racers)]
+    # Distinct names, as in the real data, without digits (which would be
+    # removed by cleaning), e.g. 'Baker-Qc'
+    last = np.array([f'{LAST_NAMES[i % len(LAST_NAMES)]}-{letters(i)}'
+                     for i in rng.permutation(num_racers)], dtype=object)
+    bad = rng.random(num_racers) < bad_name_rate
+    first[bad] = np.where(rng.random(bad.sum()) < 0.5, 'Unknown', '')
+    age = rng.integers(14, 75, num_racers)
+
+    # Results: each category draws its racers by participation weight, and
+    # places them by skill plus noise. Racers drawn twice for the same
+    # category are dropped.
+    category = np.repeat(np.arange(len(sizes)), sizes)
+    results = pd.DataFrame({'category': category,
+                            'racer': rng.choice(num_racers, len(category),
+                                                p=weights)})
+    results = results.drop_duplicates().reset_index(drop=True)
+    results['performance'] = skill[results['racer']] \
+                             + rng.normal(0, 0.7, len(results))
+    results['Place'] = (results.groupby('category')['performance']
+                               .rank(ascending=False, method='first')
+                               .astype(int))
+
+    outcome = rng.random(len(results))
+    results['IsDnf'] = (outcome < dnf_rate).astype(int)
+    results['IsDNP'] = ((outcome >= dnf_rate)
+                        & (outcome < dnf_rate + dnp_rate)).astype(int)
+    results['IsDQ'] = ((outcome >= dnf_rate + dnp_rate)
+                       & (outcome < dnf_rate + dnp_rate + dq_rate)).astype(int)
+
+    race_index = race_of_category[results['category']]
+    racer = results['racer'].to_numpy()
+    results['ResultID'] = np.arange(1, len(results) + 1)
+    results['RacerID'] = racer + 1
+    results['FirstName'] = first[racer]
+    results['LastName'] = last[racer]
+    results['CalculatedAge'] = age[racer]
+    results['ReportedAge'] = np.where(rng.random(len(results)) < 0.3,
+                                      age[racer], 0)
+    results['Category'] = racer_category[racer]
+    results['TeamID'] = racer % max(1, num_racers // 20) + 1
+    results['TeamName'] = 'Team ' + results['TeamID'].astype(str)
+    results['race_id'] = race_index + 1
+    results['RaceName'] = races['name'].to_numpy()[race_index]
+    results['RaceCategoryName'] = np.array(CATEGORIES)[
+        (results['category'] - np.searchsorted(race_of_category,
+                                               race_index))
+        % len(CATEGORIES)]
+    results = results.drop(columns=['category', 'racer', 'performance'])
+
+    return records(races), records(results)
+
+
+def letters(i):
+    """Spell the integer i in letters: 0 -> 'A', 25 -> 'Z', 26 -> 'Ba'..."""
+    s = chr(65 + i % 26)
+    i //= 26
+    while i:
+        s += chr(97 + i % 26)
+        i //= 26
+    return s
+
+
+def records(df):
+    """Rows of df as a list of dictionaries of Python (not NumPy) values."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')